@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import copy
+import logging
+from typing import List, Optional
+
+import yaml
+
+import Commonds
+import MultipleBLEConnect as ble
+from CameraStatus import status_of
+from ClockSync import capture_log
+from DownloadEngine import DownloadEngine
+from SyncIndex import SyncIndex
+from TransferSession import TransferSession
+from WifiManager import WifiManager
+
+logger = logging.getLogger('rich')
+
+DEFAULT_BATTERY_MIN = 20
+DEFAULT_MIN_READY = 1
+# 等相机空闲的最长时间，超时后就用当时空闲的相机拍
+DEFAULT_READY_TIMEOUT = 600.0
+
+IDLE = 'idle'
+CAPTURING = 'capturing'
+PENDING = 'pending offload'
+OFFLOADING = 'offloading'
+
+
+class PlanStep:
+    def __init__(self, mode: str = 'photo', time=2, interval: int = 2, repeat: int = 1,
+                 min_ready: Optional[int] = None):
+        self.mode = mode
+        self.time = time
+        self.interval = interval
+        self.repeat = repeat
+        self.min_ready = min_ready
+
+    def paras(self, base: argparse.Namespace) -> argparse.Namespace:
+        # 复用命令行参数（下载目录、线程数等），只替换拍摄相关的字段
+        paras = copy.copy(base)
+        paras.mode = self.mode
+        paras.time = self.time
+        paras.interval = self.interval
+        return paras
+
+
+class CapturePlan:
+    def __init__(self, steps: List[PlanStep], battery_min: int = DEFAULT_BATTERY_MIN,
+                 min_ready: int = DEFAULT_MIN_READY, ready_timeout: float = DEFAULT_READY_TIMEOUT):
+        self.steps = steps
+        self.battery_min = battery_min
+        self.min_ready = min_ready
+        self.ready_timeout = ready_timeout
+
+    @classmethod
+    def load(cls, path: str) -> 'CapturePlan':
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+        steps = [PlanStep(**step) for step in data.pop('steps', [])]
+        return cls(steps, **data)
+
+
+class CameraSlot:
+    def __init__(self, camera):
+        self.camera = camera
+        self.state = IDLE
+
+    @property
+    def connected(self) -> bool:
+        return self.camera.get('bleak_client').is_connected
+
+
+class BatchRunner:
+    def __init__(self, camera_list, wifi_list, paras: argparse.Namespace, plan: CapturePlan):
+        # wifi_list: the wifi_profile entries filled by connect2wifi
+        self.wifi_list = wifi_list
+        self.paras = paras
+        self.plan = plan
+        self.slots = [CameraSlot(camera) for camera in camera_list]
+        self.index = SyncIndex.in_dir(paras.file[0])
+        self.shots = 0
+        self._offload = False
+        self._queue: Optional[asyncio.Queue] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    async def battery_ok(self, slot: CameraSlot) -> bool:
+        status = status_of(slot.camera)
+        if status is not None and status.battery is not None:
+            # 推送过来的电量，不用再读一次
+            level = status.battery
+        else:
+            try:
+                value = await slot.camera.get('bleak_client').read_gatt_char(Commonds.Characteristics.BatteryLevel)
+            except Exception as e:
+                logger.error(f'Read battery of {slot.camera.get("target")} failed: {e!r}')
+                return True
+            if not value:
+                return True
+            level = value[0]
+        if level < self.plan.battery_min:
+            logger.error(f'Camera {slot.camera.get("target")} battery {level}% is below '
+                         f'{self.plan.battery_min}%, skipping it')
+            return False
+        return True
+
+    async def _ready(self) -> List[CameraSlot]:
+        idle = [slot for slot in self.slots if slot.state == IDLE and slot.connected]
+        ok = await asyncio.gather(*(self.battery_ok(slot) for slot in idle))
+        return [slot for slot, good in zip(idle, ok) if good]
+
+    async def _wait_ready(self, min_ready: int) -> List[CameraSlot]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.plan.ready_timeout
+        while True:
+            ready = await self._ready()
+            busy = any(slot.state != IDLE for slot in self.slots)
+            if len(ready) >= min_ready or not busy or loop.time() >= deadline:
+                return ready
+            # 有相机下载完才会有变化
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_step(self, step: PlanStep):
+        ready = await self._wait_ready(step.min_ready or self.plan.min_ready)
+        if not ready:
+            logger.error(f'No camera ready for {step.mode} step, skipping it')
+            return
+        paras = step.paras(self.paras)
+        cameras = [slot.camera for slot in ready]
+        logger.info(f'{step.mode} step on {[camera.get("target") for camera in cameras]}')
+        for slot in ready:
+            slot.state = CAPTURING
+        try:
+            payload = ble.make_payload(Commonds.CommandsType.PRESETS, paras)
+            await asyncio.gather(*(ble.set_camera(camera.get('bleak_client'), camera, payload) for camera in cameras))
+            await ble.record(cameras, ble.make_payload(Commonds.CommandsType.RECORD, paras))
+            self.shots += 1
+        finally:
+            # 拍完的相机交给下载队列，其它空闲的相机可以继续拍下一批
+            for slot in ready:
+                if self._offload:
+                    slot.state = PENDING
+                    self._queue.put_nowait((slot, paras))
+                else:
+                    slot.state = IDLE
+
+    def _wifi_for(self, slot: CameraSlot):
+        for wifi in self.wifi_list:
+            if wifi.get('address') == slot.camera.get('address'):
+                return wifi
+        return None
+
+    async def _offload_worker(self, manager: WifiManager, engine: DownloadEngine):
+        loop = asyncio.get_running_loop()
+        while True:
+            slot, paras = await self._queue.get()
+            slot.state = OFFLOADING
+            try:
+                wifi = self._wifi_for(slot)
+                if wifi is None:
+                    logger.error(f'No Wi-Fi credentials for {slot.camera.get("target")}, cannot offload')
+                    continue
+                await ble.enable_ap(slot.camera.get('bleak_client'), slot.camera)
+                async with TransferSession([slot.camera], [wifi], enabled=not paras.no_turbo):
+                    await loop.run_in_executor(None, ble.offload_camera, wifi, manager, engine, self.index, paras)
+            except Exception as e:
+                logger.error(f'Offload {slot.camera.get("target")} failed: {e!r}')
+            finally:
+                slot.state = IDLE
+                self._changed.set()
+                self._queue.task_done()
+
+    async def run(self):
+        self._queue = asyncio.Queue()
+        self._changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        managers = ble.wifi_managers(self.paras)
+        self._offload = bool(managers)
+        if not managers:
+            logger.error('No Wi-Fi interface found, capturing without offload')
+        # 每个网卡一个下载worker，同一时间一个网卡只连一个相机的AP
+        post = ble.post_processor(self.paras) if managers else None
+        engines = [ble.make_engine(self.paras, post) for _ in managers]
+        workers = [loop.create_task(self._offload_worker(manager, engine), name=f'Offload {manager.name}')
+                   for manager, engine in zip(managers, engines)]
+        try:
+            for step in self.plan.steps:
+                for _ in range(int(step.repeat)):
+                    await self._run_step(step)
+            await self._queue.join()
+        finally:
+            capture_log.save(self.paras.file[0])
+            for worker in workers:
+                worker.cancel()
+            if post is not None:
+                post.close()
+            for engine in engines:
+                engine.summary()
+                engine.close()
+        hours = (loop.time() - started) / 3600
+        logger.info(f'{self.shots} batches in {hours * 60:.1f} min '
+                    f'({self.shots / hours if hours else 0:.1f} batches/hour)')
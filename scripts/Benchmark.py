@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of MultipleBLEConnect against GoProSimulator, for 1..N cameras.
+Usage: python3 Benchmark.py -c 6 --json bench.json
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import Commonds
+import Discovery
+import GoProSimulator
+import HttpClient
+import MultipleBLEConnect as ble
+from CaptureScheduler import CaptureScheduler
+from CredentialCache import CredentialCache
+from DownloadEngine import DownloadEngine, DownloadJob
+from MediaCatalog import MediaCatalog
+
+logger = logging.getLogger('rich')
+
+
+async def bench_ble(count: int, paras) -> dict:
+    res = {}
+    start = time.monotonic()
+    found = await Discovery.discover(count=count, timeout=paras.scan_timeout)
+    res['scan_s'] = time.monotonic() - start
+
+    camera_list = [ble.make_camera(address, name) for address, name in found.items()]
+    start = time.monotonic()
+    await asyncio.gather(*(ble.connect(camera.get('bleak_client'), camera, is_wifi_on=True)
+                           for camera in camera_list))
+    res['connect_s'] = time.monotonic() - start
+
+    paras.mode = 'photo'
+    payload = ble.make_payload(Commonds.CommandsType.PRESETS, paras)
+    start = time.monotonic()
+    await asyncio.gather(*(ble.set_camera(camera.get('bleak_client'), camera, payload) for camera in camera_list))
+    res['preset_s'] = time.monotonic() - start
+
+    payload = ble.make_payload(Commonds.CommandsType.RECORD, paras)
+    reports = await CaptureScheduler(camera_list).capture(payload)
+    skews = [report.skew for report in reports if report.command == 'photo']
+    res['trigger_skew_ms_mean'] = statistics.mean(skews) * 1000 if skews else 0.0
+    res['trigger_skew_ms_max'] = max(skews) * 1000 if skews else 0.0
+
+    await asyncio.gather(*(ble.disconnect(camera.get('bleak_client'), camera) for camera in camera_list))
+    return res
+
+
+def bench_http(rig: GoProSimulator.SimRig, paras) -> dict:
+    res = {'list_s': 0.0, 'photo_bytes': 0, 'photo_s': 0.0, 'video_bytes': 0, 'video_s': 0.0}
+    out = tempfile.mkdtemp(prefix='gopro-bench-')
+    engine = DownloadEngine(workers=paras.workers, buffer_size=paras.buffer_size)
+    try:
+        for camera, server in zip(rig.cameras, rig.servers):
+            start = time.monotonic()
+            response = HttpClient.get(server.base_url + Commonds.Commands.WiFi.GET_MEDIA_LIST)
+            catalog = MediaCatalog.from_media_list(response.json())
+            res['list_s'] += time.monotonic() - start
+
+            download_url = server.base_url + Commonds.Commands.WiFi.MEDIA_ROOT
+            jobs = [DownloadJob(download_url + '/' + catalog.path(i), os.path.join(out, camera.ssid, catalog.names[i]),
+                                catalog.size[i]) for i in catalog.newest(paras.shots, ext='jpg')]
+            start = time.monotonic()
+            engine.download(camera.ssid + '-photo', jobs)
+            res['photo_s'] += time.monotonic() - start
+            res['photo_bytes'] += sum(job.received for job in jobs)
+
+            for i in catalog.newest(1, ext='mp4'):
+                job = DownloadJob(download_url + '/' + catalog.path(i), os.path.join(out, camera.ssid, catalog.names[i]),
+                                  catalog.size[i])
+                start = time.monotonic()
+                engine.download_segmented(camera.ssid + '-video', job, segments=paras.segments)
+                res['video_s'] += time.monotonic() - start
+                res['video_bytes'] += job.received
+    finally:
+        engine.close()
+        shutil.rmtree(out, ignore_errors=True)
+    res['photo_MBps'] = res['photo_bytes'] / res['photo_s'] / 1e6 if res['photo_s'] else 0.0
+    res['video_MBps'] = res['video_bytes'] / res['video_s'] / 1e6 if res['video_s'] else 0.0
+    return res
+
+
+def run(paras) -> list:
+    config = GoProSimulator.SimConfig(ble_latency=paras.ble_latency / 1000, bandwidth=paras.bandwidth * 1e6,
+                                      photos=paras.photos, photo_size=paras.photo_size,
+                                      video_size=paras.video_size)
+    # 不要动用户真正的缓存
+    cache_dir = tempfile.mkdtemp(prefix='gopro-bench-cache-')
+    ble.credential_cache = CredentialCache(os.path.join(cache_dir, 'wifi.json'))
+    results = []
+    try:
+        for count in range(1, paras.cameras + 1):
+            with GoProSimulator.SimRig(count, config) as rig:
+                rig.install(ble, Discovery)
+                res = {'cameras': count}
+                res.update(asyncio.run(bench_ble(count, paras)))
+                res.update(bench_http(rig, paras))
+                results.append(res)
+                logger.info(json.dumps(res))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def print_table(results: list):
+    columns = ['cameras', 'scan_s', 'connect_s', 'preset_s', 'trigger_skew_ms_mean', 'trigger_skew_ms_max',
+               'list_s', 'photo_MBps', 'video_MBps']
+    print(' '.join(f'{c:>20}' for c in columns))
+    for res in results:
+        print(' '.join(f'{res[c]:>20.3f}' if isinstance(res[c], float) else f'{res[c]:>20}' for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GoPro rig benchmark (simulated cameras)')
+    parser.add_argument('-c', '--cameras', type=int, help='最多模拟几台相机，从1台跑到N台', default=4)
+    parser.add_argument('-t', '--shots', type=int, help='每台相机拍/下载的照片数', default=5)
+    parser.add_argument('-i', '--interval', type=float, help='拍照间隔', default=0.2)
+    parser.add_argument('--photos', type=int, help='每台相机卡里的照片数', default=200)
+    parser.add_argument('--photo-size', type=int, default=2 << 20)
+    parser.add_argument('--video-size', type=int, default=64 << 20)
+    parser.add_argument('--bandwidth', type=float, help='每台相机的带宽(MB/s)，0为不限', default=20.0)
+    parser.add_argument('--ble-latency', type=float, help='BLE单次往返延迟(ms)', default=20.0)
+    parser.add_argument('--scan-timeout', type=float, default=10.0)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('-b', '--buffer-size', type=int, default=1 << 20)
+    parser.add_argument('-s', '--segments', type=int, default=4)
+    parser.add_argument('--json', help='结果写到这个json文件', default=None)
+    args = parser.parse_args()
+    # make_payload expects the CLI's time field
+    args.time = args.shots
+    results = run(args)
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# GoPro BLE 每个包最多20字节，消息太长要拆成一个起始包加若干续包
+DEFAULT_MTU = 20
+
+CONTINUATION = 0x80
+HEADER_GENERAL = 0x00
+HEADER_EXT_13 = 0x20
+HEADER_EXT_16 = 0x40
+HEADER_TYPE_MASK = 0x60
+
+MAX_GENERAL = (1 << 5) - 1
+MAX_EXT_13 = (1 << 13) - 1
+MAX_EXT_16 = (1 << 16) - 1
+
+
+def header(length: int) -> bytes:
+    if length <= MAX_GENERAL:
+        return bytes((HEADER_GENERAL | length,))
+    if length <= MAX_EXT_13:
+        return bytes((HEADER_EXT_13 | (length >> 8), length & 0xFF))
+    if length <= MAX_EXT_16:
+        return bytes((HEADER_EXT_16, length >> 8, length & 0xFF))
+    raise ValueError(f'Message of {length} bytes is too long')
+
+
+def parse_header(packet) -> Tuple[int, int]:
+    # returns (message length, header length) of a start packet
+    kind = packet[0] & HEADER_TYPE_MASK
+    if kind == HEADER_GENERAL:
+        return packet[0] & 0x1F, 1
+    if kind == HEADER_EXT_13:
+        return ((packet[0] & 0x1F) << 8) | packet[1], 2
+    if kind == HEADER_EXT_16:
+        return (packet[1] << 8) | packet[2], 3
+    raise ValueError(f'Unknown header 0x{packet[0]:02x}')
+
+
+def is_continuation(packet) -> bool:
+    return bool(packet[0] & CONTINUATION)
+
+
+def message_of(packet) -> memoryview:
+    # payload of a single start packet (id, params...) without the header
+    length, offset = parse_header(packet)
+    return memoryview(packet)[offset:offset + length]
+
+
+def fragment(message: bytes, mtu: int = DEFAULT_MTU) -> Tuple[bytes, ...]:
+    head = header(len(message))
+    first = mtu - len(head)
+    if len(message) <= first:
+        return (head + message,)
+    packets = [head + message[:first]]
+    counter = 0
+    for start in range(first, len(message), mtu - 1):
+        packets.append(bytes((CONTINUATION | (counter & 0x0F),)) + message[start:start + mtu - 1])
+        counter += 1
+    return tuple(packets)
+
+
+@lru_cache(maxsize=256)
+def encode(command_id: int, *params: bytes, mtu: int = DEFAULT_MTU) -> Tuple[bytes, ...]:
+    # (command id, params) -> 已经分好包的不可变字节串，同样的命令只编码一次
+    message = bytearray((command_id,))
+    for param in params:
+        message.append(len(param))
+        message += param
+    return fragment(bytes(message), mtu)
+
+
+@lru_cache(maxsize=256)
+def encode_raw(message: bytes, mtu: int = DEFAULT_MTU) -> Tuple[bytes, ...]:
+    # message already in wire order (e.g. protobuf feature/action/body)
+    return fragment(message, mtu)
+
+
+def compile_command(command) -> Tuple[bytes, ...]:
+    # 把Commonds.Commands里自带长度头的bytearray转换成分好包的不可变字节串
+    return encode_raw(bytes(message_of(bytes(command))))
+
+
+class Reassembler:
+    def __init__(self):
+        self._buffer: Optional[bytearray] = None
+        self._view: Optional[memoryview] = None
+        self._filled = 0
+        self._counter = 0
+
+    @property
+    def busy(self) -> bool:
+        return self._buffer is not None
+
+    def reset(self):
+        self._buffer = None
+        self._view = None
+        self._filled = 0
+        self._counter = 0
+
+    def _write(self, data: memoryview):
+        n = min(len(data), len(self._buffer) - self._filled)
+        self._view[self._filled:self._filled + n] = data[:n]
+        self._filled += n
+
+    def feed(self, packet) -> Optional[bytearray]:
+        # 返回完整的消息（不含头），还没收完的时候返回None
+        data = memoryview(packet)
+        if is_continuation(packet):
+            if self._buffer is None:
+                raise ValueError('Continuation packet without a start packet')
+            if (packet[0] & 0x0F) != (self._counter & 0x0F):
+                self.reset()
+                raise ValueError('Continuation packet out of order')
+            self._counter += 1
+            self._write(data[1:])
+        else:
+            length, offset = parse_header(packet)
+            if len(data) - offset >= length:
+                self.reset()
+                return bytearray(data[offset:offset + length])
+            # 知道总长度之后一次性分配，后续包直接写进去
+            self._buffer = bytearray(length)
+            self._view = memoryview(self._buffer)
+            self._filled = 0
+            self._counter = 0
+            self._write(data[offset:])
+        if self._filled < len(self._buffer):
+            return None
+        # 直接把缓冲区交出去，不再拷贝
+        message = self._buffer
+        self.reset()
+        return message
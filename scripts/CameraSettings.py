@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional
+
+from bleak import BleakClient
+
+import BlePacket
+import Commonds
+from ResponseTracker import ResponseTracker
+
+logger = logging.getLogger('rich')
+
+GET_SETTING_VALUES = 0x12
+GET_STATUS_VALUES = 0x13
+LOAD_PRESET_GROUP = 0x3E
+
+
+def to_value(value) -> bytes:
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return int(value).to_bytes(1 if 0 <= int(value) <= 0xFF else 4, 'big')
+
+
+# 每台相机缓存一份当前的设置和状态，只写和缓存不同的设置
+class CameraSettings:
+    def __init__(self, client: BleakClient, camera):
+        self.client = client
+        self.camera = camera
+        self.settings: Dict[int, bytes] = {}
+        self.status: Dict[int, bytes] = {}
+        # presets change many settings at once, re-query before the next diff
+        self.stale = True
+
+    @property
+    def tracker(self) -> Optional[ResponseTracker]:
+        return self.camera.get('tracker')
+
+    async def refresh(self, status_ids: Iterable[int] = ()):
+        # 一次查询所有设置（不带id就是全部），状态只查需要的；查询都发到StatusCharacteristic
+        if self.tracker is None:
+            return
+        response = await self.tracker.send(BlePacket.encode_raw(bytes((GET_SETTING_VALUES,))),
+                                           Commonds.Characteristics.StatusCharacteristic)
+        self.settings = dict(response.params)
+        status_ids = bytes(status_ids)
+        if status_ids:
+            response = await self.tracker.send(BlePacket.encode_raw(bytes((GET_STATUS_VALUES,)) + status_ids),
+                                               Commonds.Characteristics.StatusCharacteristic)
+            self.status.update(response.params)
+        self.stale = False
+
+    async def _send(self, packets, characteristic: str):
+        # 没有订阅通知的时候只能盲写，拿不到回复
+        if self.tracker is None:
+            for packet in packets:
+                await self.client.write_gatt_char(characteristic, packet, response=True)
+        else:
+            await self.tracker.send(packets, characteristic)
+
+    async def _write(self, setting_id: int, value: bytes):
+        await self._send(BlePacket.encode(setting_id, value), Commonds.Characteristics.SettingCharacteristic)
+        self.settings[setting_id] = value
+
+    async def apply_preset_group(self, group: int):
+        if self.tracker is not None and self.stale:
+            await self.refresh((Commonds.StatusId.PRESET_GROUP,))
+        current = self.status.get(Commonds.StatusId.PRESET_GROUP)
+        if current is not None and int.from_bytes(current, 'big') == group:
+            logger.info(f'Camera {self.camera.get("target")} is already in preset group {group}')
+            return
+        await self._send(BlePacket.encode(LOAD_PRESET_GROUP, group.to_bytes(2, 'big')),
+                         Commonds.Characteristics.ControlCharacteristic)
+        self.status[Commonds.StatusId.PRESET_GROUP] = group.to_bytes(4, 'big')
+        self.stale = True
+
+    async def apply(self, desired: Dict[int, object]) -> Dict[int, bytes]:
+        # 返回真正写了的设置
+        if self.tracker is not None and self.stale:
+            await self.refresh((Commonds.StatusId.PRESET_GROUP,))
+        changes = {}
+        for setting_id, value in desired.items():
+            value = to_value(value)
+            current = self.settings.get(setting_id)
+            if current is None or int.from_bytes(current, 'big') != int.from_bytes(value, 'big'):
+                changes[setting_id] = value
+        if changes:
+            # 同一台相机的多个设置也同时在途，由ResponseTracker限制并发
+            await asyncio.gather(*(self._write(setting_id, value) for setting_id, value in changes.items()))
+        logger.info(f'Camera {self.camera.get("target")}: {len(changes)} of {len(desired)} settings written')
+        return changes
+
+
+def settings_for(client: BleakClient, camera) -> CameraSettings:
+    settings = camera.get('settings')
+    if settings is None or settings.client is not client:
+        settings = CameraSettings(client, camera)
+        camera['settings'] = settings
+    return settings
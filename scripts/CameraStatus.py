@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import BlePacket
+import Commonds
+from ResponseTracker import ResponseTracker, Response
+
+logger = logging.getLogger('rich')
+
+REGISTER_STATUS_UPDATES = 0x53
+STATUS_PUSH = 0x93
+
+# 订阅这些状态，相机状态一变就会推送过来
+WATCHED = (
+    Commonds.StatusId.SYSTEM_BUSY,
+    Commonds.StatusId.ENCODING,
+    Commonds.StatusId.SD_REMAINING_KB,
+    Commonds.StatusId.AP_STATE,
+    Commonds.StatusId.BATTERY_PERCENTAGE,
+    Commonds.StatusId.SYSTEM_READY,
+    Commonds.StatusId.PRESET_GROUP,
+)
+
+DEFAULT_READY_TIMEOUT = 10.0
+DEFAULT_ENCODING_TIMEOUT = 30.0
+DEFAULT_AP_TIMEOUT = 15.0
+
+
+# 每台相机一张状态表，只在事件循环里的通知回调中更新，不需要加锁
+class CameraStatus:
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        self.values: Dict[int, int] = {}
+        self.updated = 0.0
+        self._waiters: List[Tuple[Callable[['CameraStatus'], bool], asyncio.Future]] = []
+
+    @property
+    def ready(self) -> bool:
+        # 还没收到的状态按空闲算，不要因为少一个字段卡住
+        return (self.values.get(Commonds.StatusId.SYSTEM_READY, 1) == 1
+                and self.values.get(Commonds.StatusId.SYSTEM_BUSY, 0) == 0)
+
+    @property
+    def encoding(self) -> bool:
+        return self.values.get(Commonds.StatusId.ENCODING, 0) == 1
+
+    @property
+    def ap_up(self) -> bool:
+        return self.values.get(Commonds.StatusId.AP_STATE, 0) == 1
+
+    @property
+    def battery(self) -> Optional[int]:
+        return self.values.get(Commonds.StatusId.BATTERY_PERCENTAGE)
+
+    @property
+    def sd_remaining_kb(self) -> Optional[int]:
+        return self.values.get(Commonds.StatusId.SD_REMAINING_KB)
+
+    def update(self, params: Dict[int, bytes]):
+        for status_id, value in params.items():
+            self.values[status_id] = int.from_bytes(value, 'big')
+        self.updated = time.monotonic()
+        waiters, self._waiters = self._waiters, []
+        for predicate, future in waiters:
+            if future.done():
+                continue
+            if predicate(self):
+                future.set_result(True)
+            else:
+                self._waiters.append((predicate, future))
+
+    def on_push(self, response: Response):
+        self.update(response.params)
+
+    async def subscribe(self, tracker: ResponseTracker):
+        tracker.listen(Commonds.Characteristics.StatusNotifications, STATUS_PUSH, self.on_push)
+        # 注册的回复里就带着当前值
+        response = await tracker.send(BlePacket.encode_raw(bytes((REGISTER_STATUS_UPDATES,) + WATCHED)),
+                                      Commonds.Characteristics.StatusCharacteristic)
+        self.update(response.params)
+        logger.info(f'Camera {self.name} status: {self}')
+
+    async def wait_for(self, predicate: Callable[['CameraStatus'], bool], timeout: float, what: str) -> bool:
+        if predicate(self):
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((predicate, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.error(f'Camera {self.name} not {what} after {timeout}s: {self}')
+            return False
+
+    async def wait_ready(self, timeout: float = DEFAULT_READY_TIMEOUT) -> bool:
+        return await self.wait_for(lambda status: status.ready, timeout, 'ready')
+
+    async def wait_encoding_done(self, timeout: float = DEFAULT_ENCODING_TIMEOUT) -> bool:
+        return await self.wait_for(lambda status: not status.encoding and status.ready, timeout, 'done encoding')
+
+    async def wait_ap_up(self, timeout: float = DEFAULT_AP_TIMEOUT) -> bool:
+        return await self.wait_for(lambda status: status.ap_up, timeout, 'AP up')
+
+    def __repr__(self):
+        return (f'ready={self.ready} encoding={self.encoding} ap={self.ap_up} battery={self.battery}% '
+                f'sd={self.sd_remaining_kb}KB')
+
+
+def status_of(camera) -> Optional[CameraStatus]:
+    return camera.get('status')
+
+
+async def subscribe(camera) -> Optional[CameraStatus]:
+    tracker: Optional[ResponseTracker] = camera.get('tracker')
+    if tracker is None:
+        return None
+    status = CameraStatus(camera.get('target'))
+    try:
+        await status.subscribe(tracker)
+    except Exception as e:
+        logger.error(f'Register status updates of {camera.get("target")} failed: {e!r}')
+        return None
+    camera['status'] = status
+    return status
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+'''
+Resident GoPro controller: keeps every camera's BLE session warm and exposes
+capture, preset and download as ROS topics.
+'''
+import argparse
+import asyncio
+import copy
+import logging
+import threading
+from typing import List, Optional
+
+import rospy
+from std_msgs.msg import Empty, String
+
+import ClockSync
+import Commonds
+import MultipleBLEConnect as ble
+from TransferSession import TransferSession
+from WifiManager import WifiManager
+
+logger = logging.getLogger('rich')
+
+DEFAULT_KEEPALIVE = 3.0
+MAX_RECONNECT_BACKOFF = 30.0
+
+
+class CaptureDaemon:
+    def __init__(self, paras: argparse.Namespace, keepalive: float = DEFAULT_KEEPALIVE):
+        self.paras = paras
+        self.keepalive = keepalive
+        self.camera_list: List[dict] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # BLE写命令和下载不能同时进行
+        self._busy: Optional[asyncio.Lock] = None
+        self._supervisors: List[asyncio.Task] = []
+        self.managers: List[WifiManager] = []
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._busy = asyncio.Lock()
+        self.camera_list, connecting = await ble.discover_cameras(self.loop, self.paras)
+        logger.info(self.camera_list)
+        if connecting:
+            await asyncio.wait(connecting)
+        ble.capture_log.load(self.paras.file[0])
+        ble.advertise_photos(self.paras)
+        # 网卡只枚举一次，每次下载/预览都复用，已经加过的Wi-Fi配置也不会被清掉
+        self.managers = ble.wifi_managers(self.paras)
+        if not self.paras.no_clock_sync:
+            await ClockSync.sync_all(self.camera_list)
+        for camera in self.camera_list:
+            self._supervisors.append(self.loop.create_task(self._supervise(camera),
+                                                           name=f'Supervise {camera.get("target")}'))
+
+    async def _supervise(self, camera):
+        # 定时发keepalive，断开了就按指数退避重连
+        client = camera.get('bleak_client')
+        backoff = 1.0
+        while True:
+            if not client.is_connected:
+                logger.error(f'Camera {camera.get("target")} lost, reconnecting')
+                await ble.connect(client, camera, is_wifi_on=True)
+                if not client.is_connected:
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
+                    continue
+                backoff = 1.0
+            try:
+                await ble.send_command(client, camera, Commonds.Commands.KeepAlive.Trigger,
+                                       Commonds.Characteristics.SettingCharacteristic)
+            except Exception as e:
+                logger.error(f'Keepalive to {camera.get("target")} failed: {e!r}')
+            await asyncio.sleep(self.keepalive)
+
+    def _paras(self, mode: Optional[str] = None) -> argparse.Namespace:
+        paras = copy.copy(self.paras)
+        if mode:
+            paras.mode = mode
+        return paras
+
+    async def preset(self, mode: Optional[str] = None):
+        payload = ble.make_payload(Commonds.CommandsType.PRESETS, self._paras(mode))
+        async with self._busy:
+            await asyncio.gather(*(ble.set_camera(camera.get('bleak_client'), camera, payload)
+                                   for camera in self.camera_list))
+
+    async def capture(self, mode: Optional[str] = None):
+        payload = ble.make_payload(Commonds.CommandsType.RECORD, self._paras(mode))
+        async with self._busy:
+            reports = await ble.record(self.camera_list, payload)
+        ble.capture_log.save(self.paras.file[0])
+        return reports
+
+    async def download(self, mode: Optional[str] = None):
+        async with self._busy:
+            await ble.enable_ap_all(self.camera_list)
+            paras = self._paras(mode)
+            async with TransferSession(self.camera_list, ble.wifi_profile, enabled=not paras.no_turbo):
+                # download_file是同步的（换Wi-Fi + HTTP），放到线程里跑，不阻塞keepalive
+                await self.loop.run_in_executor(None, ble.download_file, list(ble.wifi_profile), paras,
+                                                self.managers)
+
+    async def preview(self, kind: Optional[str] = None):
+        paras = self._paras()
+        paras.preview = kind or paras.preview or 'thumbnail'
+        async with self._busy:
+            await ble.enable_ap_all(self.camera_list)
+            return await self.loop.run_in_executor(None, ble.preview_file, list(ble.wifi_profile), paras,
+                                                   None, self.managers)
+
+    async def stop(self):
+        for task in self._supervisors:
+            task.cancel()
+        await asyncio.gather(*(ble.disconnect(camera.get('bleak_client'), camera) for camera in self.camera_list))
+        ble.close_photo_publisher()
+
+    def submit(self, coro):
+        # 给ROS回调线程用
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+class CaptureDaemonNode(object):
+    def __init__(self, daemon: CaptureDaemon):
+        self.daemon = daemon
+        self.p_status = rospy.Publisher('gp_ble_status', String, queue_size=10)
+        rospy.Subscriber('gp_ble_capture', String, self.cb_capture)
+        rospy.Subscriber('gp_ble_preset', String, self.cb_preset)
+        rospy.Subscriber('gp_ble_download', String, self.cb_download)
+        rospy.Subscriber('gp_ble_preview', String, self.cb_preview)
+        rospy.Subscriber('gp_ble_trigger', Empty, self.cb_trigger)
+
+    def _run(self, name, coro):
+        rospy.loginfo(name + " requested\n")
+        future = self.daemon.submit(coro)
+        future.add_done_callback(lambda f: self._done(name, f))
+
+    def _done(self, name, future):
+        if future.exception() is not None:
+            self.p_status.publish(String(data=f'{name} failed: {future.exception()!r}'))
+        else:
+            self.p_status.publish(String(data=f'{name} done'))
+
+    # msg.data为空时使用启动参数里的模式
+    def cb_capture(self, msg):
+        self._run('capture', self.daemon.capture(msg.data or None))
+
+    def cb_preset(self, msg):
+        self._run('preset', self.daemon.preset(msg.data or None))
+
+    def cb_download(self, msg):
+        self._run('download', self.daemon.download(msg.data or None))
+
+    def cb_preview(self, msg):
+        self._run('preview', self.daemon.preview(msg.data or None))
+
+    def cb_trigger(self, msg):
+        self._run('capture', self.daemon.capture())
+
+
+def init():
+    rospy.init_node('gopro_daemon', anonymous=True)
+    rospy.loginfo("Starting gopro daemon: " + rospy.get_name() + "...\n")
+    # 各阶段的耗时定时发布到/diagnostics
+    ble.report.publish_diagnostics_every()
+    parser = ble.build_parser()
+    parser.add_argument('-k', '--keepalive', type=float, help='keepalive间隔(秒)', default=DEFAULT_KEEPALIVE)
+    paras = parser.parse_args(rospy.myargv()[1:])
+    daemon = CaptureDaemon(paras, keepalive=paras.keepalive)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    asyncio.run_coroutine_threadsafe(daemon.start(), loop).result()
+
+    CaptureDaemonNode(daemon)
+    rospy.spin()
+    asyncio.run_coroutine_threadsafe(daemon.stop(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == '__main__':
+    try:
+        init()
+    except rospy.ROSInterruptException:
+        print("GoPro daemon -> Disconnected")
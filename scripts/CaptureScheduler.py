@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from typing import Dict, List
+
+from bleak import BleakClient
+
+import Commonds
+from CameraStatus import status_of
+
+logger = logging.getLogger('rich')
+
+# 所有相机都准备好之后，留出这么多时间再统一触发，保证每个写命令都能在同一时刻发出
+DEFAULT_LEAD_TIME = 0.3
+
+
+class ShotReport:
+    def __init__(self, shot: int, command: str, deadline: float):
+        self.shot = shot
+        self.command = command
+        self.deadline = deadline
+        # camera -> seconds between the deadline and the write being acknowledged
+        self.latency: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+
+    @property
+    def skew(self) -> float:
+        if not self.latency:
+            return 0.0
+        return max(self.latency.values()) - min(self.latency.values())
+
+    def __repr__(self):
+        per_camera = ', '.join(f'{k}: {v * 1000:.1f}ms' for k, v in self.latency.items())
+        return f'shot {self.shot} {self.command} skew {self.skew * 1000:.1f}ms ({per_camera})'
+
+
+class CaptureScheduler:
+    def __init__(self, camera_list, lead_time: float = DEFAULT_LEAD_TIME):
+        self.camera_list = camera_list
+        self.lead_time = lead_time
+        self.armed: List[dict] = []
+        self.reports: List[ShotReport] = []
+
+    @staticmethod
+    def _now() -> float:
+        # event loop clock is monotonic
+        return asyncio.get_running_loop().time()
+
+    async def arm(self) -> List[dict]:
+        async def check(camera):
+            client: BleakClient = camera.get('bleak_client')
+            if client is None or not client.is_connected:
+                logger.error(f'Camera {camera.get("target")} is not connected, skipping it')
+                return None
+            status = status_of(camera)
+            if status is not None and not await status.wait_ready():
+                logger.error(f'Camera {camera.get("target")} is busy, skipping it')
+                return None
+            return camera
+
+        armed = await asyncio.gather(*(check(camera) for camera in self.camera_list))
+        self.armed = [camera for camera in armed if camera is not None]
+        logger.info(f'{len(self.armed)} of {len(self.camera_list)} cameras armed')
+        return self.armed
+
+    async def _fire_one(self, camera, command: bytearray, deadline: float, report: ShotReport):
+        delay = deadline - self._now()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            tracker = camera.get('tracker')
+            if tracker is not None:
+                # 等到相机真正回复了才算触发完成
+                await tracker.send(command)
+            else:
+                await camera.get('bleak_client').write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
+                                                                 command, response=True)
+            report.latency[camera.get('target')] = self._now() - deadline
+        except Exception as e:
+            report.errors[camera.get('target')] = repr(e)
+            logger.error(f'Camera {camera.get("target")} {report.command} failed: {e!r}')
+
+    async def fire_at(self, deadline: float, command: bytearray, name: str, shot: int = 0) -> ShotReport:
+        report = ShotReport(shot, name, deadline)
+        await asyncio.gather(*(self._fire_one(camera, command, deadline, report) for camera in self.armed))
+        self.reports.append(report)
+        logger.info(f'Trigger {report}')
+        return report
+
+    async def wait_idle(self):
+        # 拍完之后等相机写完卡再返回，后面的下载/下一次拍摄不会撞上正在编码的相机
+        await asyncio.gather(*(status_of(camera).wait_encoding_done() for camera in self.armed
+                               if status_of(camera) is not None))
+
+    async def record_video(self, payload: Commonds.CapturePayLoad):
+        start = self._now() + self.lead_time
+        logger.info('start recording!')
+        await self.fire_at(start, Commonds.Commands.Shutter.Start, 'start')
+        # 停止的时间点也按开始的deadline算，不受开始命令耗时影响
+        await self.fire_at(start + float(payload.time_span), Commonds.Commands.Shutter.Stop, 'stop')
+        logger.info('Stop Command sent successfully!')
+
+    async def photo_burst(self, payload: Commonds.CapturePayLoad):
+        interval = float(payload.photo_interval)
+        t0 = self._now() + self.lead_time
+        for i in range(int(payload.time_span)):
+            # 第i张的时刻固定是 t0 + i*interval，误差不会累积
+            deadline = t0 + i * interval
+            logger.info('Start photoing!')
+            await self.fire_at(deadline, Commonds.Commands.Shutter.Start, 'photo', shot=i)
+            await self.fire_at(max(self._now(), deadline + interval / 2), Commonds.Commands.Shutter.Stop, 'stop',
+                               shot=i)
+
+    async def capture(self, payload: Commonds.CapturePayLoad) -> List[ShotReport]:
+        if not await self.arm():
+            logger.error('No camera armed, nothing to capture')
+            return self.reports
+        if payload.capture_mode == Commonds.CaptureMode.PHOTO:
+            await self.photo_burst(payload)
+        elif payload.capture_mode == Commonds.CaptureMode.VIDEO:
+            await self.record_video(payload)
+        await self.wait_idle()
+        return self.reports
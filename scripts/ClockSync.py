@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import asyncio
+import calendar
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import BlePacket
+import Commonds
+from ResponseTracker import ResponseTracker
+
+logger = logging.getLogger('rich')
+
+SET_DATE_TIME = 0x0D
+GET_DATE_TIME = 0x0E
+EVENTS_FILE = 'capture_events.json'
+# 相机时钟只精确到秒，文件的mod也是秒，窗口两边各放宽这么多
+DEFAULT_SLACK = 2.0
+MAX_SAMPLES = 32
+# 相机时间只有秒级精度，样本跨度太短的时候拟合出来的漂移全是噪声
+MIN_DRIFT_SPAN = 300.0
+
+
+def local_seconds(wall: float) -> float:
+    # 相机的时间（包括media list里的mod）是不带时区的本地时间，按UTC算成秒
+    return calendar.timegm(time.localtime(wall)) + wall % 1
+
+
+def wall_of(monotonic: float) -> float:
+    return time.time() - (time.monotonic() - monotonic)
+
+
+def encode_datetime(seconds: float) -> bytes:
+    t = time.gmtime(int(seconds))
+    return t.tm_year.to_bytes(2, 'big') + bytes((t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec))
+
+
+def decode_datetime(value: bytes) -> int:
+    return calendar.timegm((int.from_bytes(value[:2], 'big'), value[2], value[3], value[4], value[5], value[6]))
+
+
+# 每台相机的时钟模型：offset = 相机时间 - 主机本地时间，对主机monotonic时间做线性拟合得到漂移
+class CameraClock:
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        # (host monotonic, offset seconds, uncertainty seconds)
+        self.samples: Deque[Tuple[float, float, float]] = deque(maxlen=MAX_SAMPLES)
+
+    def add(self, monotonic: float, offset: float, uncertainty: float):
+        self.samples.append((monotonic, offset, uncertainty))
+
+    def reset(self):
+        # 重新设置了相机时间，之前的样本作废
+        self.samples.clear()
+
+    @property
+    def drift(self) -> float:
+        # seconds of camera time gained per host second, least squares over the samples
+        if len(self.samples) < 2 or self.samples[-1][0] - self.samples[0][0] < MIN_DRIFT_SPAN:
+            return 0.0
+        n = len(self.samples)
+        mean_t = sum(s[0] for s in self.samples) / n
+        mean_o = sum(s[1] for s in self.samples) / n
+        var = sum((s[0] - mean_t) ** 2 for s in self.samples)
+        if var <= 0:
+            return 0.0
+        return sum((s[0] - mean_t) * (s[1] - mean_o) for s in self.samples) / var
+
+    def offset_at(self, monotonic: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        if self.samples[-1][0] - self.samples[0][0] < MIN_DRIFT_SPAN:
+            # 跨度太短就用最近的样本
+            return self.samples[-1][1]
+        n = len(self.samples)
+        mean_t = sum(s[0] for s in self.samples) / n
+        mean_o = sum(s[1] for s in self.samples) / n
+        return mean_o + self.drift * (monotonic - mean_t)
+
+    @property
+    def uncertainty(self) -> float:
+        return min((s[2] for s in self.samples), default=math.inf)
+
+    def to_camera_time(self, monotonic: float) -> Optional[float]:
+        offset = self.offset_at(monotonic)
+        if offset is None:
+            return None
+        return local_seconds(wall_of(monotonic)) + offset
+
+    def __repr__(self):
+        offset = self.offset_at(time.monotonic())
+        if offset is None:
+            return f'{self.name}: no samples'
+        return f'{self.name}: offset {offset:+.2f}s ±{self.uncertainty:.2f}s, drift {self.drift * 1e6:+.1f}ppm'
+
+
+# address -> clock, the offload threads only have the wifi entry, not the camera
+clocks: Dict[str, CameraClock] = {}
+
+
+def clock_of(camera) -> CameraClock:
+    clock = camera.get('clock')
+    if clock is None:
+        clock = CameraClock(camera.get('target'))
+        camera['clock'] = clock
+        if camera.get('address'):
+            clocks[camera.get('address')] = clock
+    return clock
+
+
+def host_time(address: Optional[str], camera_seconds: float) -> float:
+    # 相机时间（比如media list的mod）换回主机的wall clock；没采过样的相机只去掉本地时区
+    clock = clocks.get(address)
+    offset = clock.offset_at(time.monotonic()) if clock is not None else None
+    local = camera_seconds - (offset or 0.0)
+    return local - (local_seconds(local) - local)
+
+
+async def set_time(camera) -> bool:
+    tracker: Optional[ResponseTracker] = camera.get('tracker')
+    packets = BlePacket.encode(SET_DATE_TIME, encode_datetime(local_seconds(time.time())))
+    try:
+        if tracker is None:
+            for packet in packets:
+                await camera.get('bleak_client').write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
+                                                                 packet, response=True)
+        else:
+            await tracker.send(packets)
+    except Exception as e:
+        logger.error(f'Set date/time of {camera.get("target")} failed: {e!r}')
+        return False
+    clock_of(camera).reset()
+    return True
+
+
+async def sample(camera) -> bool:
+    # 读一次相机时间，用请求往返的中点作为对应的主机时间
+    tracker: Optional[ResponseTracker] = camera.get('tracker')
+    if tracker is None:
+        return False
+    sent = time.monotonic()
+    try:
+        response = await tracker.send(BlePacket.encode(GET_DATE_TIME))
+    except Exception as e:
+        logger.error(f'Get date/time of {camera.get("target")} failed: {e!r}')
+        return False
+    received = time.monotonic()
+    payload = response.payload
+    if not payload or payload[0] < 7 or len(payload) < 8:
+        logger.error(f'Unexpected date/time from {camera.get("target")}: {response}')
+        return False
+    middle = (sent + received) / 2
+    # 相机把秒截断了，取这一秒的中间
+    offset = decode_datetime(payload[1:8]) + 0.5 - local_seconds(wall_of(middle))
+    clock_of(camera).add(middle, offset, 0.5 + (received - sent) / 2)
+    return True
+
+
+async def sync_all(camera_list) -> List[bool]:
+    # 所有相机同时设置时间，再各采一次样
+    connected = [camera for camera in camera_list if camera.get('bleak_client').is_connected]
+    await asyncio.gather(*(set_time(camera) for camera in connected))
+    res = await asyncio.gather(*(sample(camera) for camera in connected))
+    for camera in connected:
+        logger.info(f'Clock {clock_of(camera)}')
+    return res
+
+
+class CaptureEvent:
+    def __init__(self, event_id: int, mode: str, start: float, end: float):
+        self.id = event_id
+        self.mode = mode
+        # host wall clock of the first and last trigger
+        self.start = start
+        self.end = end
+        # camera address -> [first, last] in camera time (the media list's mod), slack included
+        self.windows: Dict[str, List[int]] = {}
+        self.offsets: Dict[str, Dict[str, float]] = {}
+
+    def to_dict(self) -> Dict:
+        return {'id': self.id, 'mode': self.mode, 'start': self.start, 'end': self.end, 'windows': self.windows,
+                'offsets': self.offsets}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CaptureEvent':
+        event = cls(data['id'], data['mode'], data['start'], data['end'])
+        event.windows = data.get('windows', {})
+        event.offsets = data.get('offsets', {})
+        return event
+
+
+# 每次触发记录一条事件，下载时按相机时间窗口挑文件
+class CaptureLog:
+    def __init__(self, slack: float = DEFAULT_SLACK):
+        self.slack = slack
+        self.events: List[CaptureEvent] = []
+        self._lock = threading.Lock()
+
+    async def record(self, camera_list, reports, mode: str) -> Optional[CaptureEvent]:
+        # reports: CaptureScheduler的ShotReport，deadline是主机monotonic时间
+        deadlines = [report.deadline for report in reports]
+        if not deadlines:
+            return None
+        first, last = min(deadlines), max(deadlines)
+        # 每次触发后重新采样，偏移和漂移都跟着更新
+        await asyncio.gather(*(sample(camera) for camera in camera_list))
+        with self._lock:
+            event = CaptureEvent(len(self.events), mode, wall_of(first), wall_of(last))
+            self.events.append(event)
+        for camera in camera_list:
+            clock = clock_of(camera)
+            start, end = clock.to_camera_time(first), clock.to_camera_time(last)
+            if start is None:
+                continue
+            slack = self.slack + clock.uncertainty
+            event.windows[camera.get('address')] = [math.floor(start - slack), math.ceil(end + slack)]
+            event.offsets[camera.get('address')] = {'offset': clock.offset_at(first), 'drift': clock.drift,
+                                                    'uncertainty': clock.uncertainty}
+        logger.info(f'Capture event {event.id}: {event.windows}')
+        return event
+
+    def window_for(self, address: str, event_id: Optional[int] = None) -> Optional[List[int]]:
+        # 默认是这台相机最近的一次触发
+        with self._lock:
+            events = list(self.events)
+        for event in reversed(events):
+            if (event_id is None or event.id == event_id) and address in event.windows:
+                return event.windows[address]
+        return None
+
+    def load(self, directory: str):
+        # 上次运行记下的窗口，重启之后下载上一次触发的文件也能按窗口挑
+        path = os.path.join(directory, EVENTS_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                events = [CaptureEvent.from_dict(event) for event in json.load(f).get('events', [])]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f'Capture log {path} is unreadable, starting empty: {e!r}')
+            return
+        with self._lock:
+            self.events = events + self.events
+            for i, event in enumerate(self.events):
+                event.id = i
+
+    def save(self, directory: str):
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, EVENTS_FILE)
+        tmp = path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump({'events': [event.to_dict() for event in self.events]}, f, indent=2)
+            os.replace(tmp, path)
+
+
+capture_log = CaptureLog()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from typing import Optional
+from typing import Dict, Optional
 from enum import Enum
 
 BLE_CHAR_STRING = "0000{}-0000-1000-8000-00805f9b34fb"
@@ -24,6 +24,24 @@ class VideoRes(Enum):
     SuperRES = 2
 
 
+class PresetGroup:
+    VIDEO = 1000
+    PHOTO = 1001
+    TIMELAPSE = 1002
+
+
+class SettingId:
+    RESOLUTION = 2
+
+
+# VideoRes -> value of SettingId.RESOLUTION
+RESOLUTION_VALUE = {
+    VideoRes.LowRES: 9,
+    VideoRes.HighRES: 4,
+    VideoRes.SuperRES: 24,
+}
+
+
 class CaptureMode(Enum):
     VIDEO = 0
     PHOTO = 1
@@ -71,6 +89,9 @@ class Commands:
         OFF = bytearray(b'\x03\x17\x01\x00')
         GET_MEDIA_LIST = '/gopro/media/list'
         DOWNLOAD_FIlE = '/videos/DCIM/100GOPRO'
+        MEDIA_ROOT = '/videos/DCIM'
+        MEDIA_ROOT_API = '/gopro/media'
+        KEEP_ALIVE = '/gopro/camera/keep_alive'
 
     # OpenGoPro commands
     class Presets:
@@ -98,10 +119,28 @@ class Commands:
         ON = bytearray(b'\x04\xF1\x6B\x08\x01')
         OFF = bytearray(b'\x04\xF1\x6B\x08\x00')
 
+    class Status:
+        # written to StatusCharacteristic, answered on StatusNotifications
+        ApState = bytearray(b'\x02\x13\x45')
+
+    class KeepAlive:
+        # written to SettingCharacteristic
+        Trigger = bytearray(b'\x03\x5B\x01\x42')
+
     class Analytics:
         SetThirdPartyClient = bytearray(b'\x01\x50')
 
 
+class StatusId:
+    SYSTEM_BUSY = 8
+    ENCODING = 10
+    SD_REMAINING_KB = 54
+    AP_STATE = 69
+    BATTERY_PERCENTAGE = 70
+    SYSTEM_READY = 82
+    PRESET_GROUP = 96
+
+
 class Characteristics:
     Control = BLE_CHAR_STRING.format("FEA6".lower())
     Info = BLE_CHAR_STRING.format("180A".lower())
@@ -126,7 +165,8 @@ class Characteristics:
 
 
 class CapturePayLoad:
-    def __init__(self, command_type: CommandsType, time_span: Optional[float], resolution: VideoRes, mode: CaptureMode,interval:int):
+    def __init__(self, command_type: CommandsType, time_span: Optional[float], resolution: VideoRes, mode: CaptureMode,interval:int,
+                 settings: Optional[Dict[int, int]] = None):
         self.command_type = command_type
         # if the mode is video,the time_span represents recording time,
         # but if the mode is photo,the time_span represents the pic's amount you took
@@ -134,3 +174,5 @@ class CapturePayLoad:
         self.capture_mode = mode
         self.resolution = resolution
         self.photo_interval = interval
+        # extra settings pinned on every camera, setting id -> value
+        self.settings = settings or {}
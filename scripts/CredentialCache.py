@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger('rich')
+
+DEFAULT_CACHE_FILE = os.path.expanduser('~/.ros/gopro_wifi.json')
+
+
+# 相机的Wi-Fi名和密码基本不会变，缓存到本地（按BLE地址和序列号），不用每次都通过蓝牙读
+class CredentialCache:
+    def __init__(self, path: str = DEFAULT_CACHE_FILE):
+        self.path = path
+        # address -> {'ssid', 'psw', 'serial'}
+        self.cameras: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.cameras = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f'Credential cache {path} is unreadable: {e!r}')
+
+    def get(self, address: str) -> Optional[Dict[str, str]]:
+        return self.cameras.get(address)
+
+    def put(self, address: str, profile: Dict[str, str]):
+        with self._lock:
+            self.cameras[address] = dict(profile)
+        self.save()
+
+    def forget(self, address: Optional[str] = None, ssid: Optional[str] = None):
+        with self._lock:
+            for key in [k for k, v in self.cameras.items() if k == address or v.get('ssid') == ssid]:
+                del self.cameras[key]
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with self._lock:
+            # 里面有密码，只给自己读写
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.cameras, f)
+            os.replace(tmp, self.path)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable, Optional
+
+from bleak import BleakScanner
+
+logger = logging.getLogger('rich')
+
+DEFAULT_CACHE_FILE = os.path.expanduser('~/.ros/gopro_devices.json')
+DEFAULT_SCAN_TIMEOUT = 10.0
+
+
+def is_gopro(name: Optional[str]) -> bool:
+    # 有些设备广播里没有名字
+    return bool(name) and name.split(' ')[0] == 'GoPro'
+
+
+# 记录以前见过的GoPro地址 -> 名字，下次启动可以直接连，不用等扫描
+class DeviceCache:
+    def __init__(self, path: str = DEFAULT_CACHE_FILE):
+        self.path = path
+        self.devices: Dict[str, str] = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.devices = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f'Device cache {path} is unreadable: {e!r}')
+
+    def add(self, address: str, name: str):
+        self.devices[address] = name
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.devices, f)
+        os.replace(tmp, self.path)
+
+
+async def discover(expected: Iterable[str] = (), count: Optional[int] = None,
+                   timeout: float = DEFAULT_SCAN_TIMEOUT,
+                   on_found: Optional[Callable[[str, str], None]] = None) -> Dict[str, str]:
+    # 边扫边匹配，找齐expected里的地址（或者找到count台）就提前返回
+    expected = set(expected)
+    found: Dict[str, str] = {}
+    done = asyncio.Event()
+
+    def detection_callback(device, advertisement_data):
+        name = device.name or getattr(advertisement_data, 'local_name', None)
+        if not is_gopro(name) or device.address in found:
+            return
+        found[device.address] = name
+        logger.info(f'Found:{name} {device.address}')
+        if on_found is not None:
+            on_found(device.address, name)
+        if (count and len(found) >= count) or (expected and expected.issubset(found)):
+            done.set()
+
+    scanner = BleakScanner(detection_callback=detection_callback)
+    await scanner.start()
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        missing = expected.difference(found)
+        if missing or count:
+            logger.error(f'Scan timed out with {len(found)} GoPro found, missing {sorted(missing)}')
+    finally:
+        await scanner.stop()
+    return found
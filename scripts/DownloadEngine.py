@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('rich')
+
+DEFAULT_WORKERS = 4
+# 1 MiB，比原来的8 KiB大很多，减少python每块的开销
+DEFAULT_BUFFER_SIZE = 1 << 20
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (3.05, 30)
+DEFAULT_SEGMENTS = 4
+DEFAULT_RETRIES = 5
+# 每写这么多字节就fsync一次并更新进度文件
+CHECKPOINT_BYTES = 8 << 20
+PROGRESS_SUFFIX = '.progress.json'
+# 哈希按固定大小的块算，分段的边界对齐到块上，结果和 -s 的段数无关
+HASH_BLOCK = 4 << 20
+
+
+def block_scheme(algorithm: str, block_size: int = HASH_BLOCK) -> str:
+    # manifest里记录的哈希方案名
+    return f'{algorithm}-blocks-{block_size}'
+
+
+def combine_blocks(algorithm: str, blocks: List[bytes]) -> str:
+    return hashlib.new(algorithm, b''.join(blocks)).hexdigest()
+
+
+# 对每个HASH_BLOCK大小的块各算一次摘要，文件的摘要是所有块摘要按顺序拼起来再算一次；
+# 同一份内容不管是单连接下载还是怎么分段下载，结果都一样
+class BlockHasher:
+    def __init__(self, algorithm: str, block_size: int = HASH_BLOCK):
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.blocks: List[bytes] = []
+        self._current = hashlib.new(algorithm)
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = min(self.block_size - self._filled, len(view))
+            self._current.update(view[:n])
+            self._filled += n
+            view = view[n:]
+            if self._filled == self.block_size:
+                self.blocks.append(self._current.digest())
+                self._current = hashlib.new(self.algorithm)
+                self._filled = 0
+
+    def block_digests(self) -> List[bytes]:
+        # 最后一个不满的块也算上
+        if self._filled:
+            self.blocks.append(self._current.digest())
+            self._current = hashlib.new(self.algorithm)
+            self._filled = 0
+        return self.blocks
+
+    def hexdigest(self) -> str:
+        return combine_blocks(self.algorithm, self.block_digests())
+
+
+def hash_range(path: str, start: int, end: int, hasher):
+    # 续传时补算已经在盘上的那部分
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            chunk = f.read(min(end - start, DEFAULT_BUFFER_SIZE))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            start += len(chunk)
+
+
+class DownloadJob:
+    def __init__(self, url: str, dest: str, size: Optional[int] = None):
+        self.url = url
+        self.dest = dest
+        # the 's' field of the media list, used to preallocate the output file
+        self.size = size
+        self.received = 0
+        self.retries = 0
+        self.error: Optional[Exception] = None
+        # BlockHasher hex digest computed while streaming, the same for single-stream and segmented downloads
+        self.digest: Optional[str] = None
+
+
+class CameraStats:
+    def __init__(self, camera: str):
+        self.camera = camera
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = 0.0
+        self.finished = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, job: DownloadJob):
+        with self._lock:
+            self.bytes += job.received
+            if job.error is None:
+                self.files += 1
+            else:
+                self.failed += 1
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.finished - self.started, 0.0)
+
+    @property
+    def throughput(self) -> float:
+        # bytes per second
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (f'{self.camera}: {self.files} files ({self.failed} failed), {self.bytes / 1e6:.1f} MB '
+                f'in {self.elapsed:.1f}s -> {self.throughput / 1e6:.2f} MB/s')
+
+
+def preallocate(f, size: int):
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+class DownloadEngine:
+    def __init__(self, workers: int = DEFAULT_WORKERS, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 preallocate_files: bool = True, timeout=DEFAULT_TIMEOUT, hash_algorithm: Optional[str] = None,
+                 on_complete: Optional[Callable[[DownloadJob], None]] = None):
+        self.workers = max(int(workers), 1)
+        self.buffer_size = max(int(buffer_size), 64 * 1024)
+        self.preallocate_files = preallocate_files
+        self.timeout = timeout
+        self.hash_algorithm = hash_algorithm
+        # called from the download thread with every file that landed on disk
+        self.on_complete = on_complete
+        # one persistent session per camera, so every file reuses the same keep-alive connections
+        self.sessions: Dict[str, requests.Session] = {}
+        self.pool_sizes: Dict[str, int] = {}
+        self.stats: Dict[str, CameraStats] = {}
+
+    def session_for(self, camera: str, adapter_factory=HTTPAdapter, segments: int = 1) -> requests.Session:
+        # adapter_factory lets the caller bind the connections to a given Wi-Fi interface
+        # 连接池要放得下所有worker或所有分段同时用的连接，不然多出来的连接用完就被关掉
+        pool_size = max(self.workers, int(segments))
+        session = self.sessions.get(camera)
+        if session is None or self.pool_sizes.get(camera, 0) < pool_size:
+            if session is None:
+                session = requests.Session()
+                self.sessions[camera] = session
+            else:
+                session.get_adapter('http://').close()
+            adapter = adapter_factory(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.pool_sizes[camera] = pool_size
+        return session
+
+    def fetch(self, session: requests.Session, job: DownloadJob):
+        dir_in = os.path.dirname(job.dest)
+        if dir_in and not os.path.exists(dir_in):
+            os.makedirs(dir_in, exist_ok=True)
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        # 边下边算哈希，不用下载完再读一遍文件
+        hasher = BlockHasher(self.hash_algorithm) if self.hash_algorithm else None
+        with session.get(job.url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            size = job.size or int(response.headers.get('Content-Length', 0) or 0)
+            raw = response.raw
+            with open(job.dest, 'wb') as f:
+                if self.preallocate_files:
+                    preallocate(f, size)
+                while True:
+                    n = raw.readinto(view)
+                    if not n:
+                        break
+                    f.write(view[:n])
+                    if hasher is not None:
+                        hasher.update(view[:n])
+                    job.received += n
+                # 预分配之后如果实际收到的更少，截断到真实大小
+                f.truncate(job.received)
+        if size and job.received != size:
+            raise IOError(f'{job.dest}: expected {size} bytes, got {job.received}')
+        if hasher is not None:
+            job.digest = hasher.hexdigest()
+
+    def complete(self, job: DownloadJob):
+        if self.on_complete is None:
+            return
+        try:
+            self.on_complete(job)
+        except Exception as e:
+            logger.error(f'Post-processing {job.dest} failed: {e!r}')
+
+    def fetch_bytes(self, session: requests.Session, job: DownloadJob) -> bytearray:
+        # 整个文件读到内存里，不落盘；知道大小的时候一次分配好，直接readinto
+        with session.get(job.url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            size = job.size or int(response.headers.get('Content-Length', 0) or 0)
+            data = bytearray(size or self.buffer_size)
+            view = memoryview(data)
+            raw = response.raw
+            while True:
+                if job.received == len(data):
+                    if size:
+                        break
+                    # 大小未知，按倍数扩容
+                    view.release()
+                    data.extend(bytes(len(data)))
+                    view = memoryview(data)
+                n = raw.readinto(view[job.received:])
+                if not n:
+                    break
+                job.received += n
+            view.release()
+        if size and job.received != size:
+            raise IOError(f'{job.url}: expected {size} bytes, got {job.received}')
+        del data[job.received:]
+        return data
+
+    def probe(self, session: requests.Session, job: DownloadJob):
+        # returns (size, accept ranges)
+        # 用一个字节的Range GET探测，有的相机web服务器不支持HEAD；探测失败就整个文件单连接下载
+        try:
+            with session.get(job.url, stream=True, timeout=self.timeout, headers={'Range': 'bytes=0-0'}) as response:
+                response.raise_for_status()
+                if response.status_code == 206:
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    return job.size or (int(total) if total.isdigit() else 0), True
+                return job.size or int(response.headers.get('Content-Length', 0) or 0), False
+        except requests.RequestException as e:
+            logger.error(f'Probing {job.url} failed, downloading in one piece: {e!r}')
+            return job.size or 0, False
+
+    def _load_progress(self, job: DownloadJob, size: int, segments: int):
+        progress_file = job.dest + PROGRESS_SUFFIX
+        if os.path.exists(progress_file) and os.path.exists(job.dest):
+            try:
+                with open(progress_file) as f:
+                    progress = json.load(f)
+                if progress.get('url') == job.url and progress.get('size') == size:
+                    logger.info(f'Resuming {job.dest} from {progress_file}')
+                    for seg in progress['segments']:
+                        if len(seg) < 4:
+                            seg.append(None)
+                        elif not isinstance(seg[3], list):
+                            # 旧版本记录的整段摘要，和现在的块哈希不兼容，重新算
+                            seg[3] = None
+                    return progress
+            except (OSError, ValueError) as e:
+                logger.error(f'Ignoring broken progress file {progress_file}: {e!r}')
+        # 每段的长度取整到HASH_BLOCK，这样每段的块哈希拼起来就是整个文件的块哈希
+        step = -(-size // segments)
+        step = -(-step // HASH_BLOCK) * HASH_BLOCK
+        ranges = [[start, min(start + step, size), start, None] for start in range(0, size, step)]
+        with open(job.dest, 'wb') as f:
+            if self.preallocate_files:
+                preallocate(f, size)
+            f.truncate(size)
+        return {'url': job.url, 'size': size, 'segments': ranges}
+
+    @staticmethod
+    def _save_progress(job: DownloadJob, progress):
+        progress_file = job.dest + PROGRESS_SUFFIX
+        tmp = progress_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmp, progress_file)
+
+    def _fetch_segment(self, session: requests.Session, job: DownloadJob, segment, progress, lock, hashed: bool):
+        # segment = [start, end, next byte to fetch, hex block digests of the finished segment]，end不包含
+        start, end, offset = segment[:3]
+        # 每段边下边算自己那些块的哈希，最后按顺序拼起来，不用下载完再读一遍文件
+        hasher = None
+        if hashed and segment[3] is None:
+            hasher = BlockHasher(self.hash_algorithm)
+            if offset > start:
+                hash_range(job.dest, start, offset, hasher)
+        if offset < end:
+            headers = {'Range': f'bytes={offset}-{end - 1}'}
+            buffer = bytearray(self.buffer_size)
+            view = memoryview(buffer)
+            with session.get(job.url, stream=True, timeout=self.timeout, headers=headers) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise IOError(f'{job.url} ignored the range request')
+                raw = response.raw
+                with open(job.dest, 'r+b') as f:
+                    f.seek(offset)
+                    unsynced = 0
+                    while offset < end:
+                        n = raw.readinto(view[:min(self.buffer_size, end - offset)])
+                        if not n:
+                            break
+                        f.write(view[:n])
+                        if hasher is not None:
+                            hasher.update(view[:n])
+                        offset += n
+                        unsynced += n
+                        if unsynced >= CHECKPOINT_BYTES:
+                            f.flush()
+                            os.fsync(f.fileno())
+                            unsynced = 0
+                            with lock:
+                                segment[2] = offset
+                                self._save_progress(job, progress)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    with lock:
+                        segment[2] = offset
+                        self._save_progress(job, progress)
+            if offset < end:
+                raise IOError(f'{job.url} segment {start}-{end} ended at {offset}')
+        if hasher is not None:
+            with lock:
+                segment[3] = [block.hex() for block in hasher.block_digests()]
+                self._save_progress(job, progress)
+
+    def fetch_segmented(self, session: requests.Session, job: DownloadJob, segments: int = DEFAULT_SEGMENTS,
+                        retries: int = DEFAULT_RETRIES):
+        dir_in = os.path.dirname(job.dest)
+        if dir_in and not os.path.exists(dir_in):
+            os.makedirs(dir_in, exist_ok=True)
+        size, accept_ranges = self.probe(session, job)
+        if not size or not accept_ranges:
+            logger.info(f'{job.url} does not support ranges, downloading in one piece')
+            self.fetch(session, job)
+            return
+        progress = self._load_progress(job, size, max(int(segments), 1))
+        lock = threading.Lock()
+        # 旧版本的进度文件分段没对齐到块上，只能下完再读一遍
+        hashed = bool(self.hash_algorithm) and all(seg[0] % HASH_BLOCK == 0 for seg in progress['segments'])
+        done_before = sum(seg[2] - seg[0] for seg in progress['segments'])
+        attempt = 0
+        while True:
+            pending = [seg for seg in progress['segments']
+                       if seg[2] < seg[1] or (hashed and seg[3] is None)]
+            if not pending:
+                break
+            errors = []
+            with ThreadPoolExecutor(max_workers=len(pending), thread_name_prefix='range') as pool:
+                futures = [pool.submit(self._fetch_segment, session, job, seg, progress, lock, hashed)
+                           for seg in pending]
+                for future in as_completed(futures):
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+            if not errors:
+                continue
+            attempt += 1
+            job.retries = attempt
+            if attempt > retries:
+                raise errors[0]
+            backoff = min(2 ** attempt, 30)
+            logger.error(f'{job.url}: {len(errors)} segment(s) failed ({errors[0]!r}), resuming in {backoff}s')
+            time.sleep(backoff)
+        job.received = sum(seg[2] - seg[0] for seg in progress['segments']) - done_before
+        actual = os.path.getsize(job.dest)
+        if actual != size:
+            raise IOError(f'{job.dest}: expected {size} bytes, got {actual}')
+        if hashed:
+            job.digest = combine_blocks(self.hash_algorithm,
+                                        [bytes.fromhex(block) for seg in progress['segments'] for block in seg[3]])
+        elif self.hash_algorithm:
+            hasher = BlockHasher(self.hash_algorithm)
+            hash_range(job.dest, 0, size, hasher)
+            job.digest = hasher.hexdigest()
+        os.remove(job.dest + PROGRESS_SUFFIX)
+        logger.info(f'{job.dest} verified, {size} bytes')
+
+    def download_segmented(self, camera: str, job: DownloadJob, segments: int = DEFAULT_SEGMENTS,
+                           retries: int = DEFAULT_RETRIES, adapter_factory=HTTPAdapter) -> CameraStats:
+        stats = self.stats.setdefault(camera, CameraStats(camera))
+        session = self.session_for(camera, adapter_factory, segments)
+        stats.started = stats.started or time.monotonic()
+        try:
+            logger.info(f'Downloading {job.url} to {job.dest} in {segments} segments')
+            self.fetch_segmented(session, job, segments, retries)
+            self.complete(job)
+        except Exception as e:
+            job.error = e
+            logger.error(f'Download {job.url} failed: {e!r}')
+        stats.add(job)
+        stats.finished = time.monotonic()
+        return stats
+
+    def _run_job(self, session: requests.Session, job: DownloadJob) -> DownloadJob:
+        try:
+            logger.info(f'Downloading {job.url} to {job.dest}')
+            self.fetch(session, job)
+            self.complete(job)
+        except Exception as e:
+            job.error = e
+            logger.error(f'Download {job.url} failed: {e!r}')
+        return job
+
+    def download(self, camera: str, jobs: List[DownloadJob], adapter_factory=HTTPAdapter) -> CameraStats:
+        stats = self.stats.setdefault(camera, CameraStats(camera))
+        session = self.session_for(camera, adapter_factory)
+        stats.started = stats.started or time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'dl-{camera}') as pool:
+            futures = [pool.submit(self._run_job, session, job) for job in jobs]
+            for future in as_completed(futures):
+                stats.add(future.result())
+        stats.finished = time.monotonic()
+        return stats
+
+    def _stream_job(self, session: requests.Session, job: DownloadJob, sink) -> DownloadJob:
+        try:
+            logger.info(f'Streaming {job.url}')
+            # sink可能阻塞（队列满了），这样就自然地放慢了下载
+            sink(job, self.fetch_bytes(session, job))
+        except Exception as e:
+            job.error = e
+            logger.error(f'Stream {job.url} failed: {e!r}')
+        return job
+
+    def stream(self, camera: str, jobs: List[DownloadJob], sink: Callable[[DownloadJob, bytearray], None],
+               adapter_factory=HTTPAdapter) -> CameraStats:
+        # 和download一样，只是文件内容交给sink而不是写到job.dest
+        stats = self.stats.setdefault(camera, CameraStats(camera))
+        session = self.session_for(camera, adapter_factory)
+        stats.started = stats.started or time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'st-{camera}') as pool:
+            futures = [pool.submit(self._stream_job, session, job, sink) for job in jobs]
+            for future in as_completed(futures):
+                stats.add(future.result())
+        stats.finished = time.monotonic()
+        return stats
+
+    def summary(self) -> List[CameraStats]:
+        res = list(self.stats.values())
+        for stats in res:
+            logger.info(f'Download summary {stats}')
+        return res
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+        self.pool_sizes.clear()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+'''
+Hardware-free GoPro: a fake BleakClient/BleakScanner speaking the Commonds.Characteristics
+UUIDs and a local HTTP server with the media API, for benchmarks on a laptop.
+'''
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import BlePacket
+import Commonds
+from ClockSync import decode_datetime, encode_datetime, local_seconds
+
+GET_SETTINGS = 0x12
+LOAD_PRESET_GROUP = 0x3E
+REGISTER_STATUS_UPDATES = 0x53
+SET_DATE_TIME = 0x0D
+GET_DATE_TIME = 0x0E
+TURBO_FEATURE = 0xF1
+TURBO_RESPONSE_ACTION = 0xEB
+STATUS_PUSH = 0x93
+
+
+class SimConfig:
+    def __init__(self, ble_latency: float = 0.02, ble_jitter: float = 0.005, advertise_delay: float = 0.1,
+                 connect_delay: float = 0.3, http_latency: float = 0.005, bandwidth: float = 20e6,
+                 photos: int = 50, photo_size: int = 2 << 20, videos: int = 2, video_size: int = 64 << 20,
+                 turbo_speedup: float = 1.5, clock_offset: float = 37.0, clock_drift: float = 50e-6):
+        self.ble_latency = ble_latency
+        self.ble_jitter = ble_jitter
+        self.advertise_delay = advertise_delay
+        self.connect_delay = connect_delay
+        self.http_latency = http_latency
+        # bytes per second per camera, 0 means unlimited
+        self.bandwidth = bandwidth
+        # bandwidth multiplier while turbo transfer is on
+        self.turbo_speedup = turbo_speedup
+        # camera clock minus host local time (seconds), and how fast it runs away
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self.photos = photos
+        self.photo_size = photo_size
+        self.videos = videos
+        self.video_size = video_size
+
+
+class SimCamera:
+    def __init__(self, index: int, config: SimConfig):
+        self.index = index
+        self.config = config
+        self.name = f'GoPro {1000 + index:04d}'
+        self.address = f'SI:MU:LA:TE:{index // 256:02X}:{index % 256:02X}'
+        self.serial = f'SIM{index:08d}'
+        self.ssid = f'GP{index:08d}'
+        self.password = f'sim-{index:04d}'
+        self.settings: Dict[int, bytes] = {}
+        self.status: Dict[int, bytes] = {
+            Commonds.StatusId.SYSTEM_BUSY: b'\x00',
+            Commonds.StatusId.ENCODING: b'\x00',
+            Commonds.StatusId.SD_REMAINING_KB: (32 << 20).to_bytes(8, 'big'),
+            Commonds.StatusId.AP_STATE: b'\x00',
+            Commonds.StatusId.BATTERY_PERCENTAGE: b'\x64',
+            Commonds.StatusId.SYSTEM_READY: b'\x01',
+            Commonds.StatusId.PRESET_GROUP: Commonds.PresetGroup.VIDEO.to_bytes(4, 'big'),
+        }
+        self.settings[Commonds.SettingId.RESOLUTION] = bytes((Commonds.RESOLUTION_VALUE[Commonds.VideoRes.LowRES],))
+        self.registered: set = set()
+        self.turbo = False
+        self._pushed: Dict[int, bytes] = {}
+        # host monotonic time of every Shutter.Start received
+        self.shutter_log: List[float] = []
+        self.clock_offset = config.clock_offset
+        self.clock_set_at = time.monotonic()
+        base = int(time.time()) - 3600
+        self.media = [{'n': f'GOPR{i:04d}.JPG', 'mod': str(base + i), 's': str(config.photo_size)}
+                      for i in range(config.photos)]
+        self.media += [{'n': f'GX01{i:04d}.MP4', 'mod': str(base + config.photos + i), 's': str(config.video_size)}
+                       for i in range(config.videos)]
+
+    def media_list(self) -> Dict:
+        return {'id': self.serial, 'media': [{'d': '100GOPRO', 'fs': self.media}]}
+
+    def file_size(self, name: str) -> Optional[int]:
+        for media in self.media:
+            if media['n'] == name:
+                return int(media['s'])
+        return None
+
+    def camera_time(self) -> float:
+        now = time.monotonic()
+        return (local_seconds(time.time()) + self.clock_offset
+                + self.config.clock_drift * (now - self.clock_set_at))
+
+    def _new_media(self, ext: str, size: int):
+        # new files get the camera clock as their mod, like a real camera
+        name = f'{"GOPR" if ext == "JPG" else "GX01"}{len(self.media):04d}.{ext}'
+        self.media.append({'n': name, 'mod': str(int(self.camera_time())), 's': str(size)})
+
+    def set_status(self, status_id: int, value: bytes):
+        if self.status.get(status_id) != value and status_id in self.registered:
+            self._pushed[status_id] = value
+        self.status[status_id] = value
+
+    def take_push(self) -> Optional[bytes]:
+        # status changes since the last call, as one 0x93 push message
+        if not self._pushed:
+            return None
+        pushed, self._pushed = self._pushed, {}
+        return self._tlv(STATUS_PUSH, pushed, b'')
+
+    def handle(self, characteristic: str, message: bytes) -> List[bytes]:
+        # returns the reply messages (without headers) for a complete request
+        command_id = message[0]
+        if characteristic == Commonds.Characteristics.ControlCharacteristic:
+            video = self.status[Commonds.StatusId.PRESET_GROUP] == Commonds.PresetGroup.VIDEO.to_bytes(4, 'big')
+            if bytes(message) == bytes(BlePacket.message_of(bytes(Commonds.Commands.Shutter.Start))):
+                self.shutter_log.append(time.monotonic())
+                if not video:
+                    self._new_media('JPG', self.config.photo_size)
+                self.set_status(Commonds.StatusId.ENCODING, b'\x01')
+            elif bytes(message) == bytes(BlePacket.message_of(bytes(Commonds.Commands.Shutter.Stop))):
+                if video and self.status[Commonds.StatusId.ENCODING] == b'\x01':
+                    self._new_media('MP4', self.config.video_size)
+                self.set_status(Commonds.StatusId.ENCODING, b'\x00')
+            elif command_id == SET_DATE_TIME:
+                self.clock_offset = decode_datetime(message[2:9]) - local_seconds(time.time())
+                self.clock_set_at = time.monotonic()
+            elif command_id == GET_DATE_TIME:
+                return [bytes((command_id, 0, 7)) + encode_datetime(self.camera_time())]
+            elif bytes(message) == bytes(BlePacket.message_of(bytes(Commonds.Commands.WiFi.ON))):
+                self.set_status(Commonds.StatusId.AP_STATE, b'\x01')
+            elif bytes(message) == bytes(BlePacket.message_of(bytes(Commonds.Commands.WiFi.OFF))):
+                self.set_status(Commonds.StatusId.AP_STATE, b'\x00')
+            elif command_id == TURBO_FEATURE:
+                # protobuf: feature, action, body (field 1 = active)
+                self.turbo = message[-1:] == b'\x01'
+                return [bytes((TURBO_FEATURE, TURBO_RESPONSE_ACTION, 0x08, 0x01))]
+            elif command_id == LOAD_PRESET_GROUP:
+                self.set_status(Commonds.StatusId.PRESET_GROUP, int.from_bytes(message[2:4], 'big').to_bytes(4, 'big'))
+            return [bytes((command_id, 0))]
+        if characteristic == Commonds.Characteristics.SettingCharacteristic:
+            # every message here is id/length/value, a bare id is an invalid setting write
+            if len(message) < 3:
+                return [bytes((command_id, 2))]
+            self.settings[command_id] = bytes(message[2:2 + message[1]])
+            return [bytes((command_id, 0))]
+        if characteristic == Commonds.Characteristics.StatusCharacteristic:
+            if command_id == GET_SETTINGS:
+                return [self._tlv(command_id, self.settings, message[1:])]
+            if command_id == REGISTER_STATUS_UPDATES:
+                self.registered.update(message[1:])
+            return [self._tlv(command_id, self.status, message[1:])]
+        return [bytes((command_id, 1))]
+
+    @staticmethod
+    def _tlv(command_id: int, values: Dict[int, bytes], ids: bytes) -> bytes:
+        reply = bytearray((command_id, 0))
+        for key in (ids or values.keys()):
+            value = values.get(key)
+            if value is not None:
+                reply += bytes((key, len(value))) + value
+        return bytes(reply)
+
+
+class FakeBleakClient:
+    # same surface as bleak.BleakClient for what MultipleBLEConnect uses
+    registry: Dict[str, SimCamera] = {}
+
+    def __init__(self, address, disconnected_callback: Optional[Callable] = None, **kwargs):
+        self.address = address
+        self.camera = FakeBleakClient.registry[address]
+        self.is_connected = False
+        self.disconnected_callback = disconnected_callback
+        self._notify: Dict[str, Callable] = {}
+        self._reassemblers: Dict[str, BlePacket.Reassembler] = {}
+
+    async def _delay(self, base: float):
+        config = self.camera.config
+        await asyncio.sleep(max(base + random.uniform(-config.ble_jitter, config.ble_jitter), 0))
+
+    async def connect(self, **kwargs):
+        await self._delay(self.camera.config.connect_delay)
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+        return True
+
+    async def start_notify(self, char, callback, **kwargs):
+        self._notify[getattr(char, 'uuid', char)] = callback
+
+    async def stop_notify(self, char):
+        self._notify.pop(getattr(char, 'uuid', char), None)
+
+    async def read_gatt_char(self, char, **kwargs) -> bytearray:
+        await self._delay(self.camera.config.ble_latency)
+        uuid = getattr(char, 'uuid', char)
+        values = {
+            Commonds.Characteristics.WifiAPSsidUid: self.camera.ssid,
+            Commonds.Characteristics.WifiAPPasswordUuid: self.camera.password,
+            Commonds.Characteristics.SerialNumber: self.camera.serial,
+            Commonds.Characteristics.BatteryLevel: '\x64',
+        }
+        return bytearray(values.get(uuid, '').encode())
+
+    async def write_gatt_char(self, char, data, response: bool = False):
+        if not self.is_connected:
+            raise ConnectionError(f'{self.address} is not connected')
+        uuid = getattr(char, 'uuid', char)
+        await self._delay(self.camera.config.ble_latency)
+        message = self._reassemblers.setdefault(uuid, BlePacket.Reassembler()).feed(bytes(data))
+        if message is None:
+            return
+        notify_uuid = {
+            Commonds.Characteristics.ControlCharacteristic: Commonds.Characteristics.CommandNotifications,
+            Commonds.Characteristics.SettingCharacteristic: Commonds.Characteristics.SettingNotifications,
+            Commonds.Characteristics.StatusCharacteristic: Commonds.Characteristics.StatusNotifications,
+        }.get(uuid)
+        replies = [(notify_uuid, reply) for reply in self.camera.handle(uuid, message)]
+        push = self.camera.take_push()
+        if push is not None:
+            replies.append((Commonds.Characteristics.StatusNotifications, push))
+        packets = [(reply_uuid, bytearray(packet)) for reply_uuid, reply in replies
+                   if self._notify.get(reply_uuid) is not None for packet in BlePacket.fragment(reply)]
+        if not packets:
+            return
+
+        def deliver():
+            for reply_uuid, packet in packets:
+                self._notify[reply_uuid](reply_uuid, packet)
+
+        # the notification arrives one BLE interval after the write completes
+        asyncio.get_running_loop().call_later(self.camera.config.ble_latency, deliver)
+
+
+class FakeBleakScanner:
+    cameras: List[SimCamera] = []
+
+    def __init__(self, detection_callback: Optional[Callable] = None, **kwargs):
+        self.detection_callback = detection_callback
+        self._handles = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for camera in FakeBleakScanner.cameras:
+            device = SimpleNamespace(name=camera.name, address=camera.address)
+            advertisement = SimpleNamespace(local_name=camera.name)
+            delay = camera.config.advertise_delay * random.uniform(0.5, 1.5)
+            if self.detection_callback is not None:
+                self._handles.append(loop.call_later(delay, self.detection_callback, device, advertisement))
+
+    async def stop(self):
+        for handle in self._handles:
+            handle.cancel()
+        self._handles.clear()
+
+    @classmethod
+    async def discover(cls, timeout: float = 5.0, **kwargs):
+        await asyncio.sleep(timeout)
+        return [SimpleNamespace(name=camera.name, address=camera.address) for camera in cls.cameras]
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    camera: SimCamera = None
+    chunk = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def _payload(self, name: str, start: int, end: int):
+        # deterministic content, so downloads can be verified
+        pattern = (name.encode() * (self.chunk // len(name) + 1))[:self.chunk]
+        offset = start
+        config = self.camera.config
+        bandwidth = config.bandwidth * (config.turbo_speedup if self.camera.turbo else 1.0)
+        began = time.monotonic()
+        while offset < end:
+            n = min(self.chunk - offset % self.chunk, end - offset)
+            self.wfile.write(pattern[offset % self.chunk:offset % self.chunk + n])
+            offset += n
+            if bandwidth:
+                ahead = (offset - start) / bandwidth - (time.monotonic() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def _send_json(self, body: Dict):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _media(self, head: bool):
+        name = self.path.rsplit('/', 1)[-1]
+        size = self.camera.file_size(name)
+        if size is None:
+            self.send_error(404)
+            return
+        start, end, status = 0, size, 200
+        ranges = self.headers.get('Range')
+        if ranges and ranges.startswith('bytes='):
+            first, _, last = ranges[len('bytes='):].partition('-')
+            start = int(first or 0)
+            end = min(int(last) + 1 if last else size, size)
+            status = 206
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        self.end_headers()
+        if not head:
+            self._payload(name, start, end)
+
+    def _preview(self, kind: str):
+        # thumbnail/screennail?path=100GOPRO/NAME: a few KB of deterministic bytes
+        name = self.path.rsplit('/', 1)[-1]
+        if kind not in ('thumbnail', 'screennail') or self.camera.file_size(name) is None:
+            self.send_error(404)
+            return
+        size = 4096 if kind == 'thumbnail' else 32768
+        data = (name.encode() * (size // len(name) + 1))[:size]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, head: bool):
+        time.sleep(self.camera.config.http_latency)
+        path = self.path.split('?')[0]
+        if path == Commonds.Commands.WiFi.GET_MEDIA_LIST:
+            self._send_json(self.camera.media_list())
+        elif path.startswith(Commonds.Commands.WiFi.MEDIA_ROOT_API + '/'):
+            self._preview(path.rsplit('/', 1)[-1])
+        elif path == Commonds.Commands.WiFi.KEEP_ALIVE or path.startswith('/gopro/camera/'):
+            self._send_json({})
+        elif path.startswith(Commonds.Commands.WiFi.MEDIA_ROOT):
+            self._media(head)
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+
+class SimHttpServer:
+    def __init__(self, camera: SimCamera, host: str = '127.0.0.1', port: int = 0):
+        handler = type('SimMediaHandler', (MediaHandler,), {'camera': camera})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SimRig:
+    # N simulated cameras, each with its own HTTP server
+    def __init__(self, count: int, config: Optional[SimConfig] = None):
+        self.config = config or SimConfig()
+        self.cameras = [SimCamera(i, self.config) for i in range(count)]
+        self.servers = [SimHttpServer(camera) for camera in self.cameras]
+
+    def install(self, *modules):
+        # point the given modules' BleakClient/BleakScanner at the simulator
+        FakeBleakClient.registry = {camera.address: camera for camera in self.cameras}
+        FakeBleakScanner.cameras = list(self.cameras)
+        for module in modules:
+            if hasattr(module, 'BleakClient'):
+                module.BleakClient = FakeBleakClient
+            if hasattr(module, 'BleakScanner'):
+                module.BleakScanner = FakeBleakScanner
+
+    def __enter__(self):
+        for server in self.servers:
+            server.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        for server in self.servers:
+            server.__exit__(*exc)
+
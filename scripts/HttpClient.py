@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (2.0, 10.0)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.2
+DEFAULT_POOL_SIZE = 4
+
+
+def make_retry(retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF) -> Retry:
+    # 只对GET重试；相机忙的时候会返回503
+    return Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff,
+                 status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET', 'HEAD']),
+                 raise_on_status=False)
+
+
+def make_session(pool_size: int = DEFAULT_POOL_SIZE, retries: int = DEFAULT_RETRIES,
+                 backoff: float = DEFAULT_BACKOFF, adapter_factory=HTTPAdapter) -> requests.Session:
+    session = requests.Session()
+    adapter = adapter_factory(pool_connections=1, pool_maxsize=pool_size, max_retries=make_retry(retries, backoff))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# 每个host一个keep-alive的session，两个脚本共用
+class HttpClient:
+    def __init__(self, timeout: Tuple[float, float] = DEFAULT_TIMEOUT, pool_size: int = DEFAULT_POOL_SIZE,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str) -> requests.Session:
+        host = requests.utils.urlparse(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = make_session(self.pool_size, self.retries, self.backoff)
+                self._sessions[host] = session
+            return session
+
+    def get(self, url: str, session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return (session or self.session(url)).get(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+_default: Optional[HttpClient] = None
+
+
+def default_client() -> HttpClient:
+    global _default
+    if _default is None:
+        _default = HttpClient()
+    return _default
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return default_client().get(url, **kwargs)
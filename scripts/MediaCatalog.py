@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional
+
+
+# /gopro/media/list 的结果只解析一次，按列存储：
+# 文件名放在一个list里，其余字段都是紧凑的array，几万个文件也只占很少内存
+class MediaCatalog:
+    def __init__(self):
+        self.names: List[str] = []
+        # index into self.directories / self.extensions
+        self.dir_index = array('H')
+        self.ext_index = array('H')
+        self.mod = array('q')
+        self.size = array('q')
+        self.directories: List[str] = []
+        self.extensions: List[str] = []
+        self._dir_lookup: Dict[str, int] = {}
+        self._ext_lookup: Dict[str, int] = {}
+        # indices sorted by mod, built lazily
+        self._order: Optional[array] = None
+        self._sorted_mod: Optional[array] = None
+
+    @classmethod
+    def from_media_list(cls, media_list: Dict[str, Any]) -> 'MediaCatalog':
+        catalog = cls()
+        for directory in media_list.get('media', []):
+            d = catalog._intern(directory.get('d', ''), catalog.directories, catalog._dir_lookup)
+            for media in directory.get('fs', []):
+                name = media['n']
+                ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+                catalog.names.append(name)
+                catalog.dir_index.append(d)
+                catalog.ext_index.append(catalog._intern(ext, catalog.extensions, catalog._ext_lookup))
+                catalog.mod.append(int(media.get('mod', 0)))
+                catalog.size.append(int(media.get('s', 0)))
+        return catalog
+
+    @staticmethod
+    def _intern(value: str, values: List[str], lookup: Dict[str, int]) -> int:
+        index = lookup.get(value)
+        if index is None:
+            index = len(values)
+            values.append(value)
+            lookup[value] = index
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def _ensure_order(self):
+        if self._order is None:
+            self._order = array('l', sorted(range(len(self.names)), key=self.mod.__getitem__))
+            self._sorted_mod = array('q', (self.mod[i] for i in self._order))
+
+    def _ext_code(self, ext: Optional[str]) -> Optional[int]:
+        if ext is None:
+            return None
+        return self._ext_lookup.get(ext.lower().lstrip('.'), -1)
+
+    def newest(self, count: int, ext: Optional[str] = None) -> List[int]:
+        # top-N by mod time, newest first
+        code = self._ext_code(ext)
+        if code == -1 or count <= 0:
+            return []
+        if code is None:
+            return heapq.nlargest(count, range(len(self.names)), key=self.mod.__getitem__)
+        ext_index = self.ext_index
+        return heapq.nlargest(count, (i for i in range(len(self.names)) if ext_index[i] == code),
+                              key=self.mod.__getitem__)
+
+    def between(self, start: int, end: int, ext: Optional[str] = None) -> List[int]:
+        # start <= mod <= end, oldest first
+        code = self._ext_code(ext)
+        if code == -1:
+            return []
+        self._ensure_order()
+        lo = bisect_left(self._sorted_mod, start)
+        hi = bisect_right(self._sorted_mod, end)
+        res = self._order[lo:hi].tolist()
+        if code is not None:
+            res = [i for i in res if self.ext_index[i] == code]
+        return res
+
+    def with_ext(self, ext: str) -> List[int]:
+        code = self._ext_code(ext)
+        return [i for i, c in enumerate(self.ext_index) if c == code]
+
+    def path(self, index: int) -> str:
+        # 相对于 /videos/DCIM 的路径，例如 100GOPRO/GOPR0001.JPG
+        return f'{self.directories[self.dir_index[index]]}/{self.names[index]}'
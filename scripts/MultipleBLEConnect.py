@@ -3,18 +3,31 @@ import argparse
 import asyncio
 import json
 import os
+import queue
 import sys
-import time
-from binascii import hexlify
-from bleak import BleakClient, BleakScanner
+import threading
+from bleak import BleakClient
 from rich.logging import RichHandler
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import logging
 import Commonds
 import requests
-import pywifi
-from pywifi import const
-from UtilMath import get_max_group_media
+from MediaCatalog import MediaCatalog
+from SyncIndex import SyncIndex
+from CaptureScheduler import CaptureScheduler
+from ResponseTracker import ResponseTracker
+from CameraSettings import settings_for
+import CameraStatus
+from WifiManager import WifiManager
+from CredentialCache import CredentialCache
+from Discovery import DeviceCache, discover, DEFAULT_SCAN_TIMEOUT
+from DownloadEngine import DownloadEngine, DownloadJob
+from RunReport import report
+from Preview import PreviewCache, fetch_previews
+from TransferSession import TransferSession
+import ClockSync
+from ClockSync import capture_log
+import HttpClient
 
 FORMAT = "%(message)s"
 logging.basicConfig(level='INFO', format=FORMAT, datefmt='[%X]', handlers=[RichHandler()])
@@ -26,79 +39,81 @@ current_client: BleakClient
 
 wifi_profile = []
 
+credential_cache = CredentialCache()
+# 缩略图缓存，守护进程里多次预览同一批文件时不用重复下载
+preview_cache = PreviewCache()
+
 # It will be assigned to False if any command sent failed.
 command_set_mark: bool = False
 
-
-def connect_wifi_by_ssid(ssid, psw):
-    scan_count = 10
-    while scan_count:
-        logger.info(f'scan for target wifi {ssid}   :{scan_count}')
-        wifi = pywifi.PyWiFi()
-        ifaces = wifi.interfaces()[0]
-        ifaces.disconnect()
-        ifaces.scan()
-        time.sleep(3)
-        wifi_info = ifaces.scan_results()
-        find = False
-        for wifi_ssid in wifi_info:
-            if wifi_ssid.ssid == ssid:
-                find = True
-        if find:
-            logger.info(f'Find the wifi named {ssid}')
-            scan_count = 0
-        else:
-            scan_count -= 1
-
-    ifaces.disconnect()
-    time.sleep(3)
-    # time.sleep(3)
-    profile = pywifi.Profile()
-    profile.ssid = ssid
-    profile.auth = const.AUTH_ALG_OPEN
-    profile.akm.append(const.AKM_TYPE_WPAPSK)
-    profile.cipher = const.CIPHER_TYPE_CCMP
-    profile.key = psw
-    ifaces.remove_all_network_profiles()
-    tmp_profile = ifaces.add_network_profile(profile)
-    connect_count = 1
-    while connect_count:
-        logger.info(f'connect for target wifi {ssid}   :{connect_count}')
-        ifaces.connect(tmp_profile)
-        time.sleep(5)
-        connect_count -= 1
-
-    # 需要线程挂一下，3s够了，不然换wifi导致出错
-    if ifaces.status() == const.IFACE_CONNECTED:
-        logger.info(f'Connected to {ssid} successfully!')
-    else:
-        logger.info(f'Connected to {ssid} failed!')
+# 每个网卡一个WifiManager，整个进程只建一次（建的时候会清掉网卡上的旧配置）
+_wifi_managers: Optional[List[WifiManager]] = None
 
 
 def callback_while_connect(sender, data):
     logger.info(f'Sender:{sender}, Data:{data}')
 
 
-async def scan():
-    devices = await BleakScanner.discover()
-    for device in devices:
-        logger.info(f'Found:{device}')
-    return devices
+def make_camera(address: str, name: str, **client_kwargs):
+    device_arr = name.split(' ')
+    return {'target': f'{device_arr[0]} {device_arr[1] if len(device_arr) > 1 else ""}'.strip(),
+            'enable_wifi': False,
+            'address': f'{address}',
+            'bleak_client': BleakClient(address, **client_kwargs)}
 
 
-async def is_have_notify(client: BleakClient):
-    def notification_handler(handle: int, data: bytes) -> None:
-        logger.info(f'Received response at {handle}: {hexlify(data, ":")}!r')
-        if client.services.characteristics[handle].uuid == Commonds.Characteristics.CommandNotifications and data[
-            2] == 0x00:
-            logger.info('Command sent successfully!')
-        else:
-            logger.error('Unexpected response!')
+async def discover_cameras(loop, paras, **client_kwargs):
+    # 返回(camera_list, 连接任务)；每找到一台相机就马上开始连接，不等扫描结束
+    cache = DeviceCache()
+    camera_list = []
+    connecting = []
+
+    def on_found(address, name):
+        if any(camera.get('address') == address for camera in camera_list):
+            return
+        camera = make_camera(address, name, **client_kwargs)
+        camera_list.append(camera)
+        connecting.append(loop.create_task(connect(camera.get('bleak_client'), camera, is_wifi_on=True),
+                                           name=f'Connect {camera.get("target")}'))
+
+    # 缓存里的相机直接开始连
+    for address, name in cache.devices.items():
+        on_found(address, name)
+    expected = () if paras.cameras else cache.devices.keys()
+    with report.span('scan'):
+        found = await discover(expected=expected, count=paras.cameras, timeout=paras.scan_timeout,
+                               on_found=on_found)
+    for address, name in found.items():
+        cache.add(address, name)
+    cache.save()
+    return camera_list, connecting
+
+
+RESOLUTIONS = {'1080': Commonds.VideoRes.LowRES, '2.7k': Commonds.VideoRes.HighRES, '5k': Commonds.VideoRes.SuperRES}
+
+
+def parse_settings(items) -> Dict[int, int]:
+    # ['2=9', '3=8'] -> {2: 9, 3: 8}
+    settings = {}
+    for item in items or ():
+        key, _, value = item.partition('=')
+        settings[int(key)] = int(value)
+    return settings
 
-    for service in client.services:
-        for char in service.characteristics:
-            if 'notify' in char.properties:
-                await client.start_notify(char, callback=notification_handler)
+
+def make_payload(command_type: Commonds.CommandsType, paras) -> Commonds.CapturePayLoad:
+    mode = Commonds.CaptureMode.VIDEO if paras.mode == 'video' else Commonds.CaptureMode.PHOTO
+    resolution = RESOLUTIONS[getattr(paras, 'resolution', None) or '1080']
+    return Commonds.CapturePayLoad(command_type, time_span=paras.time, resolution=resolution,
+                                   mode=mode, interval=paras.interval,
+                                   settings=parse_settings(getattr(paras, 'setting', None)))
+
+
+async def is_have_notify(client: BleakClient) -> ResponseTracker:
+    # 订阅命令/设置/状态三个通知，相机的回复会交给对应命令的future
+    tracker = ResponseTracker(client)
+    await tracker.start()
+    return tracker
 
 
 async def is_have_stop_notify(client: BleakClient):
@@ -108,136 +123,361 @@ async def is_have_stop_notify(client: BleakClient):
                 await client.stop_notify(char, callback=callback_while_connect)
 
 
+async def read_serial(client: BleakClient) -> Optional[str]:
+    try:
+        serial = await client.read_gatt_char(Commonds.Characteristics.SerialNumber)
+        return serial.decode().strip('\x00 ')
+    except Exception as e:
+        logger.error(f'Read serial number failed: {e!r}')
+        return None
+
+
 # 这里缓存一下所有的GoPro的Wi-Fi信息，用于之后下载到本地
-async def connect2wifi(client: BleakClient):
+# 缓存里有的话不走蓝牙读，也不再开关相机的AP，等真正要下载的时候再调用enable_ap
+async def connect2wifi(client: BleakClient, camera=None):
     global wifi_profile
-    ssid = await client.read_gatt_char(Commonds.Characteristics.WifiAPSsidUid)
-    ssid = ssid.decode()
-    logger.info(f'SSID is {ssid}')
-    password = await client.read_gatt_char(Commonds.Characteristics.WifiAPPasswordUuid)
-    password = password.decode()
-    logger.info(f'PassWord is {password}')
-    await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic, Commonds.Commands.WiFi.OFF,
-                                 response=True)
-    await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic, Commonds.Commands.WiFi.ON,
-                                 response=True)
+    address = camera.get('address') if camera else client.address
+    profile = credential_cache.get(address)
+    if profile is None:
+        ssid = await client.read_gatt_char(Commonds.Characteristics.WifiAPSsidUid)
+        ssid = ssid.decode()
+        logger.info(f'SSID is {ssid}')
+        password = await client.read_gatt_char(Commonds.Characteristics.WifiAPPasswordUuid)
+        password = password.decode()
+        logger.info(f'PassWord is {password}')
+        profile = {'ssid': ssid, 'psw': password, 'serial': await read_serial(client), 'address': address}
+        credential_cache.put(address, profile)
+    else:
+        logger.info(f'SSID is {profile.get("ssid")} (cached)')
+    # 重连的时候不要重复添加
+    if all(wifi.get('ssid') != profile.get('ssid') for wifi in wifi_profile):
+        wifi_profile.append(dict(profile))
+
+
+async def is_ap_on(client: BleakClient, camera) -> bool:
+    status = CameraStatus.status_of(camera)
+    if status is not None:
+        return status.ap_up
+    tracker: Optional[ResponseTracker] = camera.get('tracker')
+    if tracker is None:
+        return False
+    try:
+        response = await tracker.send(Commonds.Commands.Status.ApState, Commonds.Characteristics.StatusCharacteristic)
+        return response.params.get(Commonds.StatusId.AP_STATE, b'\x00')[:1] == b'\x01'
+    except Exception as e:
+        logger.error(f'Query AP state of {camera.get("target")} failed: {e!r}')
+        return False
+
+
+async def enable_ap(client: BleakClient, camera):
+    # AP已经开着就不动它，不再先关再开
+    if await is_ap_on(client, camera):
+        logger.info(f'Camera {camera.get("target")} wifi is already enabled')
+        return
+    await send_command(client, camera, Commonds.Commands.WiFi.ON)
+    status = CameraStatus.status_of(camera)
+    # 等相机推送AP已经起来，而不是固定等几秒
+    if status is not None and not await status.wait_ap_up():
+        return
     logger.info(f'wifi is enabled!')
-    wifi_profile.append({'ssid': ssid, 'psw': password})
+
+
+async def enable_ap_all(camera_list):
+    await asyncio.gather(*(enable_ap(camera.get('bleak_client'), camera) for camera in camera_list
+                           if camera.get('bleak_client').is_connected))
 
 
 async def connect(client, camera, is_wifi_on: bool):
     try:
         logger.info(f'Camera {camera.get("target")} Connected!')
-        await client.connect()
-        await is_have_notify(client)
+        with report.span('connect', camera.get('target')):
+            await client.connect()
+            camera['tracker'] = await is_have_notify(client)
+            await CameraStatus.subscribe(camera)
         if is_wifi_on:
-            await connect2wifi(client)
+            with report.span('connect2wifi', camera.get('target')):
+                await connect2wifi(client, camera)
     except Exception as e:
         logger.error(e)
 
 
 async def disconnect(client, camera):
     try:
+        if camera.get('tracker') is not None:
+            await camera['tracker'].stop()
+        if camera.get('settings') is not None:
+            # 重连之后设置可能被别人改过，下次重新查询
+            camera['settings'].stale = True
         await client.disconnect()
-        await client.stop_notify(Commonds.Characteristics.ControlCharacteristic)
         logger.info(f'Camera {camera.get("target")} Disconnected!')
     except Exception as e:
         logger.error(e)
 
 
+def join_camera_wifi(wifi, manager: WifiManager) -> bool:
+    with report.span('wifi_switch', wifi.get('ssid')) as span:
+        connected = manager.connect(wifi.get('ssid'), wifi.get('psw'))
+        if not connected:
+            span.error = f'could not join {wifi.get("ssid")}'
+    if not connected:
+        # 可能是缓存的密码过期了，下次连接时重新通过蓝牙读
+        credential_cache.forget(address=wifi.get('address'), ssid=wifi.get('ssid'))
+    return connected
+
+
+def select_media(catalog: MediaCatalog, wifi, paras, sync: bool = False) -> list:
+    ext = 'mp4' if paras.mode == 'video' else 'jpg'
+    if sync:
+        return catalog.with_ext(ext)
+    # 优先用最近一次触发在这台相机时钟上的时间窗口，不靠“最新的几个”去猜
+    window = capture_log.window_for(wifi.get('address'))
+    if window is not None:
+        res = catalog.between(window[0], window[1], ext=ext)
+        if res:
+            return res
+        logger.error(f'No {ext} on {wifi.get("ssid")} within {window}, falling back to the newest files')
+    return catalog.newest(1 if paras.mode == 'video' else int(paras.time), ext=ext)
+
+
 # wifi_list就是那个global wifi列表，里面存的都是字典
-def download_file(wifi_list, paras):
-    if paras.mode == 'video':
-        for wifi in wifi_list:
-            connect_wifi_by_ssid(wifi.get('ssid'), wifi.get('psw'))
-            # 连上谁的wifi下载的就是哪个相机的文件
-            media_list = get_media_list()
-            max_timestamp: int = int(0)
-            max_media = ''
-            for media in [x for x in media_list['media'][0]['fs']]:
-                if media['n'].lower().endswith('.mp4'):
-                    temp = int(media['mod'])
-                    if temp > max_timestamp:
-                        max_timestamp = temp
-                        max_media = media['n']
-
-    elif paras.mode == 'photo':
-        for indexx, wifi in enumerate(wifi_list):
-            connect_wifi_by_ssid(wifi.get('ssid'), wifi.get('psw'))
-            media_list = get_media_list()
+def offload_camera(wifi, manager: WifiManager, engine: DownloadEngine, index: SyncIndex, paras):
+    download_url = Commonds.Characteristics.GoProBaseURL + Commonds.Commands.WiFi.MEDIA_ROOT
+    # 序列号读不到的时候退回用SSID
+    serial = wifi.get('serial') or wifi.get('ssid')
+    if not join_camera_wifi(wifi, manager):
+        return
+    # 连上谁的wifi下载的就是哪个相机的文件
+    session = engine.session_for(wifi.get('ssid'), manager.adapter,
+                                 segments=paras.segments if paras.mode == 'video' else 1)
+    with report.span('list', wifi.get('ssid')):
+        catalog = MediaCatalog.from_media_list(get_media_list(session))
+    dir_in = paras.file[0] + '/' + wifi.get('ssid') + '/' + paras.mode
+    # 只发布不落盘的照片下次还要再下载
+    written = True
+    with report.span('download', wifi.get('ssid'), turbo='on' if wifi.get('turbo') else 'off') as span:
+        if paras.mode == 'video':
+            media_res_list = index.delta(serial, catalog, select_media(catalog, wifi, paras, paras.sync))
+            jobs = []
+            for media in media_res_list:
+                # 中途断开的话，再次运行会从进度文件里记录的位置继续
+                job = DownloadJob(download_url + '/' + catalog.path(media), dir_in + '/' + catalog.names[media],
+                                  catalog.size[media])
+                engine.download_segmented(wifi.get('ssid'), job, segments=paras.segments,
+                                          adapter_factory=manager.adapter)
+                jobs.append(job)
+        elif paras.mode == 'photo':
             # 找时间戳前几大的jpg格式的文件，然后下载
-            # media_find_list的长度=time_span=countdown
-            media_find_list = []
-            for media in [x for x in media_list['media'][0]['fs']]:
-                if media['n'].lower().endswith('.jpg'):
-                    media_find_list.append(media)
-            download_url = Commonds.Characteristics.GoProBaseURL + Commonds.Commands.WiFi.DOWNLOAD_FIlE
-            print('form the url:' + download_url)
-            countdown = int(paras.time)
-            media_res_list = get_max_group_media(media_find_list, countdown)
-            print(media_res_list)
-            for index in range(media_res_list.__len__()):
-                if countdown <= 0:
-                    break
-                url = download_url + '/' + str(media_res_list[index]['n'])
-                logger.info(f'Downloading {media_res_list[index]["n"]} from {download_url}')
-                with requests.get(url, stream=True) as request:
-                    request.raise_for_status()
-                    # 命名方式： 文件总目录+wifi名+文件名
-                    dir_in = paras.file[0] + '/' + wifi.get('ssid') + '/' + paras.mode
-                    if not os.path.exists(dir_in):
-                        os.makedirs(dir_in)
-                    file = dir_in + '/' + media_res_list[index]['n'].split('.')[0] + '.jpg'
-                    logger.info(f'file name is {file}')
-                    with open(file, "wb") as f:
-                        logger.info(f'Receiving binary stream to {file}...')
-                        for chunk in request.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                countdown -= 1
+            media_res_list = index.delta(serial, catalog, select_media(catalog, wifi, paras, paras.sync))
+            logger.info(f'Photos to fetch from {wifi.get("ssid")}: {[catalog.names[i] for i in media_res_list]}')
+            # 命名方式： 文件总目录+wifi名+文件名
+            jobs = []
+            for media in media_res_list:
+                file = dir_in + '/' + catalog.names[media].split('.')[0] + '.jpg'
+                jobs.append(DownloadJob(download_url + '/' + catalog.path(media), file, catalog.size[media]))
+            publisher = photo_publisher(paras)
+            if publisher is None:
+                engine.download(wifi.get('ssid'), jobs)
+            else:
+                # 直接从内存发布成ROS图片，写盘是可选的；mod是相机本地时间，换成主机时间再发
+                publisher.wait_for_subscribers(wifi.get('ssid'))
+                stamps = {job.url: ClockSync.host_time(wifi.get('address'), catalog.mod[media])
+                          for media, job in zip(media_res_list, jobs)}
+                engine.stream(wifi.get('ssid'), jobs, lambda job, data: publisher.put(wifi.get('ssid'), job, data,
+                                                                                      stamps[job.url]),
+                              manager.adapter)
+                written = publisher.tee
+                if written:
+                    # 等照片真的落盘了再记同步、交给后处理
+                    publisher.flush()
+                    for job in jobs:
+                        if job.error is None:
+                            engine.complete(job)
+        else:
+            return
+        span.add_bytes(sum(job.received for job in jobs))
+        span.retry(sum(job.retries for job in jobs))
+        failed = [job for job in jobs if job.error is not None]
+        if failed:
+            span.error = f'{len(failed)} of {len(jobs)} files failed'
+    if not written:
+        return
+    for media, job in zip(media_res_list, jobs):
+        if job.error is None:
+            index.mark(serial, catalog.names[media], catalog.size[media], catalog.mod[media])
+    # 每台相机下载完就落盘，中途退出也不会丢
+    index.save()
+
+
+_photo_publisher = None
+
+
+def photo_publisher(paras):
+    # 只有 --publish 的时候才需要rospy
+    global _photo_publisher
+    if not getattr(paras, 'publish', False):
+        return None
+    if _photo_publisher is None:
+        from PhotoPublisher import PhotoPublisher
+        _photo_publisher = PhotoPublisher(queue_size=paras.publish_queue, tee=paras.tee)
+    return _photo_publisher
+
+
+def advertise_photos(paras):
+    # 连上之后wifi_profile里就有所有相机的SSID了
+    publisher = photo_publisher(paras)
+    if publisher is not None:
+        publisher.advertise([wifi.get('ssid') for wifi in wifi_profile if wifi.get('ssid')])
+
+
+def close_photo_publisher():
+    global _photo_publisher
+    if _photo_publisher is not None:
+        _photo_publisher.close()
+        _photo_publisher = None
+
+
+def wifi_managers(paras) -> List[WifiManager]:
+    global _wifi_managers
+    if _wifi_managers is None:
+        _wifi_managers = WifiManager.all(limit=paras.interfaces)
+    return _wifi_managers
+
+
+def for_each_camera(wifi_list, managers: List[WifiManager], target):
+    # 每个网卡一个线程，各自从队列里取下一台相机，网卡越多同时处理的相机越多
+    logger.info(f'{len(wifi_list)} cameras over {[manager.name for manager in managers]}')
+    pending = queue.Queue()
+    for wifi in wifi_list:
+        pending.put(wifi)
+
+    def worker(manager: WifiManager):
+        while True:
+            try:
+                wifi = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                target(wifi, manager)
+            except Exception as e:
+                logger.error(f'Offload {wifi.get("ssid")} via {manager.name} failed: {e!r}')
+
+    threads = [threading.Thread(target=worker, args=(manager,), name=f'offload-{manager.name}')
+               for manager in managers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def post_processor(paras):
+    # 只有 --postprocess 的时候才会起进程池
+    if not getattr(paras, 'postprocess', False):
+        return None
+    from PostProcess import PostProcessor
+    return PostProcessor(paras.file[0], review_size=paras.review_size)
+
+
+def make_engine(paras, post=None) -> DownloadEngine:
+    if post is None:
+        return DownloadEngine(workers=paras.workers, buffer_size=paras.buffer_size)
+    return DownloadEngine(workers=paras.workers, buffer_size=paras.buffer_size, hash_algorithm=post.hash_algorithm,
+                          on_complete=post.submit)
+
+
+def download_file(wifi_list, paras, managers: Optional[List[WifiManager]] = None):
+    managers = managers if managers is not None else wifi_managers(paras)
+    post = post_processor(paras)
+    engine = make_engine(paras, post)
+    index = SyncIndex.in_dir(paras.file[0])
+    try:
+        for_each_camera(wifi_list, managers, lambda wifi, manager: offload_camera(wifi, manager, engine, index, paras))
+    finally:
+        if post is not None:
+            post.close()
+    engine.summary()
+    engine.close()
+    for turbo, total in report.throughput('download', 'turbo').items():
+        logger.info(f'Turbo {turbo}: {total["bytes"] / 1e6:.1f} MB in {total["seconds"]:.1f}s '
+                    f'-> {total["throughput"] / 1e6:.2f} MB/s')
+
+
+def preview_camera(wifi, manager: WifiManager, cache: PreviewCache, paras) -> Dict[str, bytes]:
+    # 只拉最新几个文件的缩略图，几KB一张，用来确认构图和曝光
+    if not join_camera_wifi(wifi, manager):
+        return {}
+    serial = wifi.get('serial') or wifi.get('ssid')
+    session = HttpClient.make_session(pool_size=paras.workers, adapter_factory=manager.adapter)
+    try:
+        with report.span('list', wifi.get('ssid')):
+            catalog = MediaCatalog.from_media_list(get_media_list(session))
+        newest = select_media(catalog, wifi, paras)
+        with report.span('preview', wifi.get('ssid')) as span:
+            previews = fetch_previews(session, catalog, newest, serial, cache, kind=paras.preview,
+                                      workers=paras.workers)
+            span.add_bytes(sum(len(data) for data in previews.values()))
+    finally:
+        session.close()
+    dir_in = paras.file[0] + '/' + wifi.get('ssid') + '/preview'
+    os.makedirs(dir_in, exist_ok=True)
+    for name, data in previews.items():
+        with open(dir_in + '/' + name.split('.')[0] + '.' + paras.preview + '.jpg', 'wb') as f:
+            f.write(data)
+    logger.info(f'{len(previews)} previews from {wifi.get("ssid")} in {dir_in}')
+    return previews
+
+
+def preview_file(wifi_list, paras, cache: Optional[PreviewCache] = None,
+                 managers: Optional[List[WifiManager]] = None) -> Dict[str, Dict[str, bytes]]:
+    # ssid -> 文件名 -> 缩略图
+    managers = managers if managers is not None else wifi_managers(paras)
+    if cache is None:
+        cache = preview_cache
+    res = {}
+
+    def target(wifi, manager: WifiManager):
+        res[wifi.get('ssid')] = preview_camera(wifi, manager, cache, paras)
+
+    for_each_camera(wifi_list, managers, target)
+    logger.info(f'Preview cache: {cache}')
+    return res
+
+
+async def send_command(client: BleakClient, camera, command: bytearray,
+                       characteristic: str = Commonds.Characteristics.ControlCharacteristic):
+    tracker: Optional[ResponseTracker] = camera.get('tracker')
+    if tracker is None:
+        await client.write_gatt_char(characteristic, command, response=True)
+        return None
+    response = await tracker.send(command, characteristic)
+    logger.info(f'Camera {camera.get("target")}: {response}')
+    return response
 
 
 async def set_camera(client: BleakClient, camera, paload_in: Commonds.CapturePayLoad):
+    with report.span('set_camera', camera.get('target')):
+        await _set_camera(client, camera, paload_in)
+
+
+async def _set_camera(client: BleakClient, camera, paload_in: Commonds.CapturePayLoad):
+    # 先切预设组，再只写和相机当前值不同的设置
+    settings = settings_for(client, camera)
+    desired = dict(paload_in.settings)
     if paload_in.capture_mode == Commonds.CaptureMode.PHOTO:
         logger.info(f'Camera {camera.get("target")} is setting to photo mode')
-        await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
-                                     Commonds.Commands.PresetGroups.Photo, response=True)
+        await settings.apply_preset_group(Commonds.PresetGroup.PHOTO)
     elif paload_in.capture_mode == Commonds.CaptureMode.VIDEO:
         logger.info(f'Camera {camera.get("target")} is setting to video mode')
-        await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
-                                     Commonds.Commands.PresetGroups.Video, response=True)
-
-
-async def record_video(client: BleakClient, camera, payload: Commonds.CapturePayLoad):
-    if payload.capture_mode == Commonds.CaptureMode.PHOTO:
-        for i in range(int(payload.time_span)):
-            logger.info(f'Start photoing!')
-            logger.info(f'Camera {camera.get("target")} is taking a photo')
-            await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
-                                         Commonds.Commands.Shutter.Start,
-                                         response=True)
-            time.sleep(payload.photo_interval)
-            await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic, Commonds.Commands.Shutter.Stop,
-                                         response=True)
-    elif payload.capture_mode == Commonds.CaptureMode.VIDEO:
-        logger.info(f'start recording!')
-        logger.info(f'Camera {camera.get("target")} is Recording')
-        await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic, Commonds.Commands.Shutter.Start,
-                                     response=True)
-        time.sleep(int(payload.time_span))
-        await client.write_gatt_char(Commonds.Characteristics.ControlCharacteristic, Commonds.Commands.Shutter.Stop,
-                                     response=True)
-        logger.info('Stop Command sent successfully!')
-        # response = requests.get(Commonds.Characteristics.GoProBaseURL + Commonds.Commands.WIFIShutter.Stop)
-        # response.raise_for_status()
-
+        await settings.apply_preset_group(Commonds.PresetGroup.VIDEO)
+        desired.setdefault(Commonds.SettingId.RESOLUTION, Commonds.RESOLUTION_VALUE[paload_in.resolution])
+    if desired:
+        await settings.apply(desired)
 
 
 # 这个就同步进行吧，在拍完之后同步连接两个GoPro的wifi然后进行下载
-def get_media_list() -> Dict[str, Any]:
+def get_media_list(session: Optional[requests.Session] = None) -> Dict[str, Any]:
     url = Commonds.Characteristics.GoProBaseURL + Commonds.Commands.WiFi.GET_MEDIA_LIST
     logger.info(f'getting the media list: sending {url}')
-    response = requests.get(url)
-    time.sleep(5)
+    response = HttpClient.get(url, session=session)
     response.raise_for_status()
     logger.info('Get media Command sent sucdessfully!')
 
@@ -246,6 +486,15 @@ def get_media_list() -> Dict[str, Any]:
     return response.json()
 
 
+async def record(camera_list, payload: Commonds.CapturePayLoad):
+    async with report.span('record'):
+        reports = await CaptureScheduler(camera_list).capture(payload)
+    # 记下这次触发在每台相机时钟上的时间窗口，下载时按窗口挑文件
+    mode = 'video' if payload.capture_mode == Commonds.CaptureMode.VIDEO else 'photo'
+    await capture_log.record(camera_list, reports, mode)
+    return reports
+
+
 def control_by_command(loop, camera_list, command_type: Optional[Commonds.CommandsType] = None, paras=None):
     if camera_list is None:
         global logger
@@ -263,84 +512,105 @@ def control_by_command(loop, camera_list, command_type: Optional[Commonds.Comman
             tasks.append(loop.create_task(disconnect(camera.get('bleak_client'), camera),
                                           name=f'Disconnect {camera.get("target")}'))
     elif command_type == Commonds.CommandsType.RECORD:
-        if paras.mode == 'video':
-            capture_payload = Commonds.CapturePayLoad(Commonds.CommandsType.RECORD, time_span=paras.time,
-                                                      resolution=Commonds.VideoRes.LowRES,
-                                                      mode=Commonds.CaptureMode.VIDEO,interval=paras.interval)
-        elif paras.mode == 'photo':
-            capture_payload = Commonds.CapturePayLoad(Commonds.CommandsType.RECORD, time_span=paras.time,
-                                                      resolution=Commonds.VideoRes.LowRES,
-                                                      mode=Commonds.CaptureMode.PHOTO, interval=paras.interval)
-        for camera in camera_list:
-            tasks.append(loop.create_task(record_video(camera.get('bleak_client'), camera, capture_payload),
-                                          name=f'Connect {camera.get("target")}'))
+        capture_payload = make_payload(Commonds.CommandsType.RECORD, paras)
+        # 所有相机由同一个调度器在同一时刻触发，而不是每个相机一个任务各自sleep
+        tasks.append(loop.create_task(record(camera_list, capture_payload), name='Record'))
     elif command_type == Commonds.CommandsType.PRESETS:
-        if paras.mode == 'photo':
-            capture_payload = Commonds.CapturePayLoad(Commonds.CommandsType.PRESETS, time_span=paras.time,
-                                                      resolution=Commonds.VideoRes.LowRES,
-                                                      mode=Commonds.CaptureMode.PHOTO,interval=paras.interval)
-        elif paras.mode == 'video':
-            capture_payload = Commonds.CapturePayLoad(Commonds.CommandsType.PRESETS, time_span=paras.time,
-                                                      resolution=Commonds.VideoRes.LowRES,
-                                                      mode=Commonds.CaptureMode.VIDEO,interval=paras.interval)
+        capture_payload = make_payload(Commonds.CommandsType.PRESETS, paras)
         for camera in camera_list:
             tasks.append(loop.create_task(set_camera(camera.get('bleak_client'), camera, capture_payload),
                                           name=f'Connect {camera.get("target")}'))
 
 
 async def mainloop(loop, paras):
-    camera_list = []
     global tasks
-    found_devices = await loop.create_task(scan())
-    # await asyncio.wait([found_devices,])
-    # def notification_handler(handler: int, data: bytes, client: BleakClient) -> None:
-    #     logger.info(f'Received response at {handler=}: {hexlify(data, ":")!r}')
-    #     if client.services.characteristics[handler].uuid == Commonds.Characteristics.CommandNotifications and data[2] == 0x00:
-    #         logger.info('Command sent successfully!')
-    #     else:
-    #         logger.error('Unexpected response!')
-    #
-    #     event.set()
-
-    for device in found_devices:
-        # char array
-        device_arr = device.name.split(' ')
-        if device_arr[0] == 'GoPro':
-            camera_list.append({'target': f'{device_arr[0]} {device_arr[1]}',
-                                'enable_wifi': False,
-                                'address': f'{device.address}',
-                                'bleak_client': BleakClient(device.address)}
-                               )
+    camera_list, connecting = await discover_cameras(loop, paras)
     logger.info(camera_list)
-
-    tasks.clear()
-    control_by_command(loop, camera_list=camera_list, command_type=Commonds.CommandsType.CONNECT, paras=paras)
-    await asyncio.wait(tasks)
+    if connecting:
+        await asyncio.wait(connecting)
+    capture_log.load(paras.file[0])
+    advertise_photos(paras)
+    if not paras.no_clock_sync:
+        with report.span('clock_sync'):
+            await ClockSync.sync_all(camera_list)
+    if paras.plan:
+        # 按计划分批拍摄，拍完的相机在后台下载，同时空闲的相机继续拍下一批
+        from BatchRunner import BatchRunner, CapturePlan
+        await BatchRunner(camera_list, wifi_profile, paras, CapturePlan.load(paras.plan)).run()
+        return
     tasks.clear()
     control_by_command(loop, camera_list=camera_list, command_type=Commonds.CommandsType.PRESETS, paras=paras)
     await asyncio.wait(tasks)
     tasks.clear()
     control_by_command(loop, camera_list=camera_list, command_type=Commonds.CommandsType.RECORD, paras=paras)
     await asyncio.wait(tasks)
+    capture_log.save(paras.file[0])
+    if paras.preview or paras.download:
+        await enable_ap_all(camera_list)
+    if paras.preview:
+        # 先看缩略图，确认没问题再下载原图
+        await loop.run_in_executor(None, preview_file, list(wifi_profile), paras)
+    if paras.download:
+        async with TransferSession(camera_list, wifi_profile, enabled=not paras.no_turbo):
+            await loop.run_in_executor(None, download_file, list(wifi_profile), paras)
     dones, pendings = await asyncio.wait(tasks)
     print(dones, pendings)
     for task in dones:
         print("Task ret:", task.result())
 
 
-if __name__ == '__main__':
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='GoPro Controller')
     parser.add_argument('-m', '--mode', help='模式选择，video和photo', default='photo')
     parser.add_argument('-t', '--time', help='记录时间，如果是photo就代表拍的张数', default='2')
     # 此命令行参数可以接收多个参数
     parser.add_argument('-f', '--file', nargs='+', help='相机存储位置', default=['/Users/pengkun/Desktop/GoProVideo/'])
     parser.add_argument('-i', '--interval', type=int, help='拍照模式下的拍照间隔', default=2)
-    args = parser.parse_args()
+    parser.add_argument('-r', '--resolution', choices=list(RESOLUTIONS), help='视频模式下的分辨率', default='1080')
+    parser.add_argument('--setting', action='append', help='额外固定的相机设置，格式为 设置id=值，可以重复',
+                        default=None)
+    parser.add_argument('-w', '--workers', type=int, help='每个相机同时下载的文件数', default=4)
+    parser.add_argument('-b', '--buffer-size', type=int, help='下载缓冲区大小(字节)', default=1 << 20)
+    parser.add_argument('-s', '--segments', type=int, help='视频模式下分段并行下载的段数', default=4)
+    parser.add_argument('-c', '--cameras', type=int, help='期望的相机数量，找齐了就停止扫描', default=None)
+    parser.add_argument('--scan-timeout', type=float, help='蓝牙扫描超时(秒)', default=DEFAULT_SCAN_TIMEOUT)
+    parser.add_argument('--interfaces', type=int, help='下载时最多使用几个Wi-Fi网卡，默认全部', default=None)
+    parser.add_argument('-d', '--download', action='store_true', help='拍完之后直接下载')
+    parser.add_argument('--no-clock-sync', action='store_true', help='不设置相机时间；仍然读相机时钟算偏移，按触发的时间窗口挑文件')
+    parser.add_argument('--no-turbo', action='store_true', help='下载时不开turbo transfer（用来对比吞吐）')
+    parser.add_argument('--preview', choices=['thumbnail', 'screennail'], default=None,
+                        help='拍完之后先拉最新文件的缩略图到 <目录>/<ssid>/preview')
+    parser.add_argument('--report', help='把各阶段耗时写到这个目录(run_report.json/.prom)', default=None)
+    parser.add_argument('--ros-diagnostics', action='store_true', help='把各阶段耗时发布到/diagnostics（latch，退出前最多等3秒让订阅者连上）')
+    parser.add_argument('--postprocess', action='store_true',
+                        help='下载的同时计算哈希、查重（<目录>/manifest.json），并生成缩小的review照片')
+    parser.add_argument('--review-size', type=int, help='review照片的长边像素，0为不生成', default=1600)
+    parser.add_argument('--publish', action='store_true',
+                        help='照片不落盘，直接发布到 gopro/<ssid>/image/compressed (sensor_msgs/CompressedImage)')
+    parser.add_argument('--publish-queue', type=int, help='发布队列里最多缓存的照片数，满了会放慢下载', default=8)
+    parser.add_argument('--tee', action='store_true', help='发布的同时也把照片写到磁盘')
+    parser.add_argument('-p', '--plan', help='拍摄计划yaml文件，按计划边拍边下载', default=None)
+    parser.add_argument('--sync', action='store_true', help='下载相机上所有还没同步过的文件，而不只是最新的几个')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
     try:
         tasks = []
+        if args.publish or args.ros_diagnostics:
+            import rospy
+            rospy.init_node('gopro_ctl', anonymous=True)
+            if args.ros_diagnostics:
+                report.advertise_diagnostics()
         loop_outer = asyncio.get_event_loop()
         task = loop_outer.create_task(mainloop(loop=loop_outer, paras=args))
         loop_outer.run_until_complete(asyncio.wait([task, ]))
+        close_photo_publisher()
+        if args.report:
+            report.write(args.report)
+        if args.ros_diagnostics:
+            report.flush_diagnostics()
         # download_file(wifi_list=wifi_profile, paras=args)
         loop_outer.close()
     except Exception as e:
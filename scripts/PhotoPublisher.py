@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+import rospy
+from sensor_msgs.msg import CompressedImage
+
+from DownloadEngine import DownloadJob
+
+logger = logging.getLogger('rich')
+
+DEFAULT_TOPIC_PREFIX = 'gopro'
+# 内存里最多排这么多张原图，满了下载线程就会等
+DEFAULT_QUEUE_SIZE = 8
+# 每台相机第一次发布前最多等这么久让订阅者连上，之后才连上的订阅者收不到之前的照片
+DEFAULT_SUBSCRIBER_WAIT = 2.0
+# close之后给rospy的发送线程留一点时间把最后几张发出去
+DRAIN_LINGER = 1.0
+
+
+def topic_name(prefix: str, camera: str) -> str:
+    return f'{prefix}/{re.sub(r"[^0-9A-Za-z_]", "_", camera)}/image/compressed'
+
+
+# 下载线程把照片放进有界队列，一个线程负责发布（和可选地写盘）
+class PhotoPublisher:
+    def __init__(self, topic_prefix: str = DEFAULT_TOPIC_PREFIX, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 tee: bool = False):
+        self.topic_prefix = topic_prefix
+        self.tee = tee
+        self.queue_size = max(int(queue_size), 1)
+        self.published = 0
+        self.dropped = 0
+        # published while nobody was subscribed
+        self.unheard = 0
+        self._publishers: Dict[str, rospy.Publisher] = {}
+        self._queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self._waited: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='photo-publisher', daemon=True)
+        self._thread.start()
+
+    def publisher_for(self, camera: str) -> rospy.Publisher:
+        with self._lock:
+            publisher = self._publishers.get(camera)
+            if publisher is None:
+                # rospy的发送队列和我们的队列一样大，一批照片不会在rospy里被悄悄挤掉
+                publisher = rospy.Publisher(topic_name(self.topic_prefix, camera), CompressedImage,
+                                            queue_size=self.queue_size)
+                self._publishers[camera] = publisher
+            return publisher
+
+    def advertise(self, cameras):
+        # 知道有哪些相机就马上advertise，订阅者在拍摄期间就能连上
+        for camera in cameras:
+            self.publisher_for(camera)
+
+    def wait_for_subscribers(self, camera: str, timeout: float = DEFAULT_SUBSCRIBER_WAIT) -> bool:
+        # 每台相机只在第一次发布前等一次
+        publisher = self.publisher_for(camera)
+        if not self._waited.get(camera):
+            self._waited[camera] = True
+            deadline = time.monotonic() + timeout
+            while publisher.get_num_connections() == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        if publisher.get_num_connections() == 0:
+            logger.error(f'No subscriber on {publisher.resolved_name}, its photos go to nobody')
+            return False
+        return True
+
+    def put(self, camera: str, job: DownloadJob, data: bytearray, stamp: Optional[float] = None):
+        # stamp: host wall clock of the capture, None for the receive time
+        # 队列满的时候阻塞，反压到下载线程
+        self._queue.put((camera, job, data, stamp))
+
+    def _publish(self, camera: str, job: DownloadJob, data: bytearray, stamp: Optional[float]):
+        msg = CompressedImage()
+        msg.header.stamp = rospy.Time.from_sec(stamp) if stamp is not None else rospy.Time.now()
+        msg.header.frame_id = camera
+        msg.format = 'jpeg'
+        # 直接用下载的缓冲区，不再拷贝一次
+        msg.data = data
+        publisher = self.publisher_for(camera)
+        if publisher.get_num_connections() == 0:
+            self.unheard += 1
+        publisher.publish(msg)
+        self.published += 1
+
+    def _write(self, job: DownloadJob, data: bytearray):
+        dir_in = os.path.dirname(job.dest)
+        if dir_in and not os.path.exists(dir_in):
+            os.makedirs(dir_in, exist_ok=True)
+        with open(job.dest, 'wb') as f:
+            f.write(data)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                camera, job, data, stamp = item
+                try:
+                    self._publish(camera, job, data, stamp)
+                except Exception as e:
+                    self.dropped += 1
+                    logger.error(f'Publish {job.url} failed: {e!r}')
+                if self.tee:
+                    try:
+                        self._write(job, data)
+                    except Exception as e:
+                        # 没写成功的不能记成已同步
+                        job.error = e
+                        logger.error(f'Write {job.dest} failed: {e!r}')
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.published and any(publisher.get_num_connections() for publisher in self._publishers.values()):
+            time.sleep(DRAIN_LINGER)
+        logger.info(f'{self.published} photos published ({self.dropped} failed, {self.unheard} with no subscriber)')
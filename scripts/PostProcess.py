@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from DownloadEngine import BlockHasher, DownloadJob, HASH_BLOCK, block_scheme
+
+logger = logging.getLogger('rich')
+
+MANIFEST_FILE = 'manifest.json'
+REVIEW_DIR = 'review'
+DEFAULT_HASH = 'sha256'
+# 缩小后的长边像素
+DEFAULT_REVIEW_SIZE = 1600
+DEFAULT_QUEUE_SIZE = 64
+HASH_CHUNK = 1 << 20
+
+
+def hash_file(path: str, algorithm: str = DEFAULT_HASH) -> str:
+    # 和下载时边下边算的是同一种块哈希
+    hasher = BlockHasher(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+# 在子进程里跑，必须是模块级的
+def downscale(src: str, dest: str, max_size: int) -> str:
+    from PIL import Image
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with Image.open(src) as image:
+        # draft让解码器直接按缩小的尺寸解JPEG，比先全尺寸解码快得多
+        image.draft('RGB', (max_size, max_size))
+        image.thumbnail((max_size, max_size))
+        image.save(dest, 'JPEG', quality=85)
+    return dest
+
+
+def has_pil() -> bool:
+    try:
+        import PIL  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+# 下载线程把完成的文件放进队列，一个线程负责记账，CPU重的活交给进程池
+class PostProcessor:
+    def __init__(self, root: str, workers: Optional[int] = None, review_size: int = DEFAULT_REVIEW_SIZE,
+                 hash_algorithm: str = DEFAULT_HASH, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.root = root
+        self.review_size = review_size
+        self.hash_algorithm = hash_algorithm
+        # digests are BlockHasher digests, not a plain hash of the file
+        self.scheme = block_scheme(hash_algorithm)
+        self.path = os.path.join(root, MANIFEST_FILE)
+        # digest -> first path (relative to root) that had this content
+        self.files: Dict[str, str] = {}
+        self.duplicates: Dict[str, str] = {}
+        self.processed = 0
+        self._lock = threading.Lock()
+        self._downscale = review_size > 0 and has_pil()
+        if review_size > 0 and not self._downscale:
+            logger.error('PIL is not installed, skipping review copies')
+        self._load()
+        # spawn：进程池是第一次提交时才起子进程的，那时下载线程都在跑，fork一个多线程进程不安全
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+            if self._downscale else None
+        self._futures: List[Future] = []
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='post-process', daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get('algorithm') != self.scheme:
+                logger.error(f'Manifest {self.path} uses {manifest.get("algorithm")}, not {self.scheme}, '
+                             f'starting empty')
+                return
+            self.files = manifest.get('files', {})
+            self.duplicates = manifest.get('duplicates', {})
+        except (OSError, ValueError) as e:
+            logger.error(f'Manifest {self.path} is unreadable, starting empty: {e!r}')
+
+    def submit(self, job: DownloadJob):
+        # DownloadEngine.on_complete，在下载线程里调用；队列满了就等，反压到下载
+        self._queue.put(job)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._process(job)
+            except Exception as e:
+                logger.error(f'Post-processing {job.dest} failed: {e!r}')
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job: DownloadJob):
+        # 下载时没有算哈希（比如发布后才写盘的照片）就在这里读一遍（hashlib会释放GIL）
+        digest = job.digest or hash_file(job.dest, self.hash_algorithm)
+        relative = os.path.relpath(job.dest, self.root)
+        with self._lock:
+            first = self.files.setdefault(digest, relative)
+            self.processed += 1
+            if first != relative:
+                self.duplicates[relative] = first
+        if first != relative:
+            logger.info(f'{relative} is a duplicate of {first}')
+            return
+        if self._downscale and job.dest.lower().endswith('.jpg'):
+            dest = os.path.join(os.path.dirname(job.dest), REVIEW_DIR, os.path.basename(job.dest))
+            self._futures.append(self._pool.submit(downscale, job.dest, dest, self.review_size))
+
+    def save(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump({'algorithm': self.scheme, 'block_size': HASH_BLOCK, 'files': self.files,
+                           'duplicates': self.duplicates}, f)
+            os.replace(tmp, self.path)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f'Downscaling failed: {e!r}')
+        if self._pool is not None:
+            self._pool.shutdown()
+        self.save()
+        logger.info(f'{self.processed} files post-processed, {len(self.duplicates)} duplicates')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+import Commonds
+import HttpClient
+from MediaCatalog import MediaCatalog
+
+logger = logging.getLogger('rich')
+
+THUMBNAIL = 'thumbnail'
+SCREENNAIL = 'screennail'
+# 缩略图几KB一张，16MB足够缓存上千张
+DEFAULT_CACHE_BYTES = 16 << 20
+
+PreviewKey = Tuple[str, str, str]
+
+
+# (相机序列号, 文件路径, 缩略图类型) -> jpeg，按总字节数淘汰最久没用的
+class PreviewCache:
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[PreviewKey, bytes]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: PreviewKey) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: PreviewKey, data: bytes):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._entries[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def __repr__(self):
+        return f'{len(self._entries)} previews, {self.bytes / 1e3:.1f} KB, {self.hits} hits, {self.misses} misses'
+
+
+def preview_url(catalog: MediaCatalog, index: int, kind: str = THUMBNAIL,
+                base_url: str = Commonds.Characteristics.GoProBaseURL) -> str:
+    return f'{base_url}{Commonds.Commands.WiFi.MEDIA_ROOT_API}/{kind}?path={catalog.path(index)}'
+
+
+def fetch_previews(session: requests.Session, catalog: MediaCatalog, indices: List[int], serial: str,
+                   cache: PreviewCache, kind: str = THUMBNAIL, workers: int = 4,
+                   base_url: str = Commonds.Characteristics.GoProBaseURL) -> Dict[str, bytes]:
+    # 返回 文件名 -> 缩略图，缓存里有的不再请求
+    res: Dict[str, bytes] = {}
+    missing = []
+    for index in indices:
+        data = cache.get((serial, catalog.path(index), kind))
+        if data is None:
+            missing.append(index)
+        else:
+            res[catalog.names[index]] = data
+
+    def fetch(index: int) -> Optional[bytes]:
+        url = preview_url(catalog, index, kind, base_url)
+        try:
+            response = HttpClient.get(url, session=session)
+            response.raise_for_status()
+            return response.content
+        except requests.RequestException as e:
+            logger.error(f'Fetch {url} failed: {e!r}')
+            return None
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(missing)), 1)) as pool:
+            for index, data in zip(missing, pool.map(fetch, missing)):
+                if data is None:
+                    continue
+                cache.put((serial, catalog.path(index), kind), data)
+                res[catalog.names[index]] = data
+    return res
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from binascii import hexlify
+from collections import deque
+from functools import partial
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from bleak import BleakClient
+
+import BlePacket
+import Commonds
+
+logger = logging.getLogger('rich')
+
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# 写命令的特征 -> 相机回复所在的通知特征
+RESPONSE_CHARACTERISTIC = {
+    Commonds.Characteristics.ControlCharacteristic: Commonds.Characteristics.CommandNotifications,
+    Commonds.Characteristics.SettingCharacteristic: Commonds.Characteristics.SettingNotifications,
+    Commonds.Characteristics.StatusCharacteristic: Commonds.Characteristics.StatusNotifications,
+}
+
+# 这两个通知里的回复参数是 id/length/value 三元组
+TLV_CHARACTERISTICS = (Commonds.Characteristics.SettingNotifications, Commonds.Characteristics.StatusNotifications)
+
+
+class ResultCode:
+    SUCCESS = 0
+    ERROR = 1
+    INVALID_PARAMETER = 2
+
+    NAMES = {SUCCESS: 'success', ERROR: 'error', INVALID_PARAMETER: 'invalid parameter'}
+
+
+class CommandError(Exception):
+    def __init__(self, command_id: int, status: int):
+        super().__init__(f'Command 0x{command_id:02x} failed: {ResultCode.NAMES.get(status, status)}')
+        self.command_id = command_id
+        self.status = status
+
+
+def decode_tlv(payload: bytes) -> Dict[int, bytes]:
+    params = {}
+    i = 0
+    while i + 2 <= len(payload):
+        length = payload[i + 1]
+        params[payload[i]] = bytes(payload[i + 2:i + 2 + length])
+        i += 2 + length
+    return params
+
+
+class Response:
+    def __init__(self, characteristic: str, message: bytes):
+        # message is the payload without the packet header: id, status, params...
+        self.characteristic = characteristic
+        self.id = message[0]
+        self.status = message[1] if len(message) > 1 else ResultCode.SUCCESS
+        self.payload = bytes(message[2:])
+        self.params = decode_tlv(self.payload) if characteristic in TLV_CHARACTERISTICS else {}
+
+    @property
+    def ok(self) -> bool:
+        return self.status == ResultCode.SUCCESS
+
+    def __repr__(self):
+        return f'Response(0x{self.id:02x}, {ResultCode.NAMES.get(self.status, self.status)}, {self.params or self.payload})'
+
+
+class ResponseTracker:
+    def __init__(self, client: BleakClient, timeout: float = DEFAULT_TIMEOUT,
+                 max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        self.client = client
+        self.timeout = timeout
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        # (notification uuid, command id) -> futures in send order, so several identical commands can be in flight
+        self._pending: Dict[Tuple[str, int], Deque[asyncio.Future]] = {}
+        self._reassemblers = {uuid: BlePacket.Reassembler() for uuid in RESPONSE_CHARACTERISTIC.values()}
+        # (notification uuid, message id) -> callbacks for messages nobody is waiting on, e.g. status pushes
+        self._listeners: Dict[Tuple[str, int], List[Callable[['Response'], None]]] = {}
+
+    def listen(self, uuid: str, message_id: int, callback: Callable[['Response'], None]):
+        self._listeners.setdefault((uuid, message_id), []).append(callback)
+
+    async def start(self):
+        for uuid in RESPONSE_CHARACTERISTIC.values():
+            await self.client.start_notify(uuid, partial(self._on_notify, uuid))
+
+    async def stop(self):
+        for uuid in RESPONSE_CHARACTERISTIC.values():
+            await self.client.stop_notify(uuid)
+        for futures in self._pending.values():
+            for future in futures:
+                future.cancel()
+        self._pending.clear()
+
+    def _on_notify(self, uuid: str, sender, data: bytearray):
+        logger.debug(f'Received response at {uuid}: {hexlify(data, ":")!r}')
+        if not data:
+            return
+        try:
+            message = self._reassemblers[uuid].feed(data)
+        except ValueError as e:
+            logger.error(f'Unexpected response at {uuid}: {hexlify(data, ":")!r} ({e})')
+            return
+        if message:
+            self.dispatch(uuid, message)
+
+    def dispatch(self, uuid: str, message: bytes):
+        response = Response(uuid, message)
+        futures = self._pending.get((uuid, response.id))
+        while futures:
+            future = futures.popleft()
+            if not future.done():
+                future.set_result(response)
+                return
+        listeners = self._listeners.get((uuid, response.id))
+        if listeners:
+            for callback in listeners:
+                callback(response)
+            return
+        logger.info(f'Unsolicited {response} at {uuid}')
+
+    async def send(self, command, characteristic: str = Commonds.Characteristics.ControlCharacteristic,
+                   timeout: Optional[float] = None, check: bool = True) -> Response:
+        # command is either a Commonds.Commands literal (with its length header) or packets from BlePacket.encode
+        packets = BlePacket.compile_command(command) if isinstance(command, (bytes, bytearray)) else command
+        command_id = BlePacket.message_of(packets[0])[0]
+        key = (RESPONSE_CHARACTERISTIC[characteristic], command_id)
+        async with self._in_flight:
+            future = asyncio.get_running_loop().create_future()
+            self._pending.setdefault(key, deque()).append(future)
+            try:
+                for packet in packets:
+                    await self.client.write_gatt_char(characteristic, packet, response=True)
+                response = await asyncio.wait_for(future, timeout or self.timeout)
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError(f'No response to 0x{command_id:02x} within {timeout or self.timeout}s')
+            finally:
+                futures = self._pending.get(key)
+                if futures and future in futures:
+                    futures.remove(future)
+        if check and not response.ok:
+            raise CommandError(response.id, response.status)
+        return response
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('rich')
+
+DIAGNOSTICS_PERIOD = 5.0
+# 退出前最多等这么久让/diagnostics的订阅者连上
+DIAGNOSTICS_WAIT = 3.0
+DIAGNOSTICS_LINGER = 0.5
+
+
+class Span:
+    def __init__(self, report: 'RunReport', phase: str, camera: Optional[str] = None, **tags):
+        self.report = report
+        self.phase = phase
+        self.camera = camera
+        # extra labels, e.g. turbo='on'
+        self.tags: Dict[str, str] = {key: str(value) for key, value in tags.items()}
+        self.start = 0.0
+        self.end = 0.0
+        self.retries = 0
+        self.bytes = 0
+        self.error: Optional[str] = None
+
+    @property
+    def elapsed(self) -> float:
+        return max(self.end - self.start, 0.0)
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def retry(self, count: int = 1):
+        self.retries += count
+
+    def add_bytes(self, count: int):
+        self.bytes += count
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.monotonic()
+        if exc is not None:
+            self.error = repr(exc)
+        self.report.add(self)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+    def to_dict(self) -> Dict:
+        return {'phase': self.phase, 'camera': self.camera, 'tags': self.tags, 'start': self.start - self.report.started,
+                'elapsed': self.elapsed, 'retries': self.retries, 'bytes': self.bytes,
+                'throughput': self.throughput, 'ok': self.error is None, 'error': self.error}
+
+
+# 每个阶段（扫描、连接、换Wi-Fi、下载……）每台相机一条记录
+class RunReport:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.wall_started = time.time()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        # /diagnostics publisher, created by advertise_diagnostics
+        self._diagnostics = None
+
+    def span(self, phase: str, camera: Optional[str] = None, **tags) -> Span:
+        return Span(self, phase, camera, **tags)
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def phases(self) -> Dict[str, Dict]:
+        res: Dict[str, Dict] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = res.setdefault(span.phase, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'retries': 0,
+                                                'bytes': 0, 'errors': 0})
+            total['count'] += 1
+            total['seconds'] += span.elapsed
+            total['max_seconds'] = max(total['max_seconds'], span.elapsed)
+            total['retries'] += span.retries
+            total['bytes'] += span.bytes
+            total['errors'] += span.error is not None
+        return res
+
+    def throughput(self, phase: str, tag: str) -> Dict[str, Dict]:
+        # 同一阶段按某个标签分组比较吞吐，比如下载时开没开turbo
+        res: Dict[str, Dict] = {}
+        with self._lock:
+            spans = [span for span in self.spans if span.phase == phase and tag in span.tags]
+        for span in spans:
+            total = res.setdefault(span.tags[tag], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += span.elapsed
+            total['bytes'] += span.bytes
+        for total in res.values():
+            total['throughput'] = total['bytes'] / total['seconds'] if total['seconds'] > 0 else 0.0
+        return res
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {'host': socket.gethostname(), 'started': self.wall_started,
+                'elapsed': time.monotonic() - self.started, 'phases': self.phases(),
+                'turbo': self.throughput('download', 'turbo'), 'spans': spans}
+
+    def to_prometheus(self) -> str:
+        lines = ['# TYPE gopro_phase_seconds gauge', '# TYPE gopro_phase_retries gauge',
+                 '# TYPE gopro_phase_bytes gauge', '# TYPE gopro_phase_ok gauge']
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            labels = f'phase="{span.phase}",camera="{span.camera or ""}"'
+            labels += ''.join(f',{key}="{value}"' for key, value in span.tags.items())
+            lines.append(f'gopro_phase_seconds{{{labels}}} {span.elapsed:.6f}')
+            lines.append(f'gopro_phase_retries{{{labels}}} {span.retries}')
+            lines.append(f'gopro_phase_bytes{{{labels}}} {span.bytes}')
+            lines.append(f'gopro_phase_ok{{{labels}}} {int(span.error is None)}')
+        lines.append(f'gopro_run_seconds {time.monotonic() - self.started:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory: str, name: str = 'run_report'):
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name + '.json'), 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        with open(os.path.join(directory, name + '.prom'), 'w') as f:
+            f.write(self.to_prometheus())
+        logger.info(f'Run report written to {directory}')
+
+    def advertise_diagnostics(self, topic: str = '/diagnostics') -> bool:
+        # init_node之后马上调用，订阅者才有时间连上来
+        if self._diagnostics is not None:
+            return True
+        # ROS是可选的，没有rospy的时候只写文件
+        try:
+            import rospy
+            from diagnostic_msgs.msg import DiagnosticArray
+        except ImportError:
+            logger.error('rospy is not available, skipping ROS diagnostics')
+            return False
+        self._diagnostics = rospy.Publisher(topic, DiagnosticArray, queue_size=1, latch=True)
+        return True
+
+    def publish_diagnostics(self):
+        if not self.advertise_diagnostics():
+            return
+        import rospy
+        from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        for phase, total in self.phases().items():
+            status = DiagnosticStatus()
+            status.name = f'{rospy.get_name()}: {phase}'
+            status.hardware_id = 'gopro'
+            status.level = DiagnosticStatus.OK if not total['errors'] else DiagnosticStatus.WARN
+            status.message = f'{total["count"]} spans, {total["seconds"]:.2f}s'
+            status.values = [KeyValue(key, str(value)) for key, value in total.items()]
+            msg.status.append(status)
+        self._diagnostics.publish(msg)
+
+    def publish_diagnostics_every(self, period: float = DIAGNOSTICS_PERIOD):
+        # 常驻进程定时发布
+        if not self.advertise_diagnostics():
+            return None
+        import rospy
+        return rospy.Timer(rospy.Duration(period), lambda event: self.publish_diagnostics())
+
+    def flush_diagnostics(self, timeout: float = DIAGNOSTICS_WAIT):
+        # 退出前发最后一次，等到有订阅者连上（latch的消息连上就会收到）或者超时
+        if self._diagnostics is None:
+            return
+        self.publish_diagnostics()
+        deadline = time.monotonic() + timeout
+        while self._diagnostics.get_num_connections() == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self._diagnostics.get_num_connections() == 0:
+            logger.error(f'No subscriber on {self._diagnostics.resolved_name} within {timeout}s')
+            return
+        # 给TCPROS一点时间把消息发出去
+        time.sleep(DIAGNOSTICS_LINGER)
+
+report = RunReport()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import threading
+from typing import Dict, List
+
+from MediaCatalog import MediaCatalog
+
+logger = logging.getLogger('rich')
+
+INDEX_FILE = 'sync_index.json'
+
+
+# 记录每台相机（按序列号区分，SSID可以被改）已经下载过的文件：name -> [size, mod]
+class SyncIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self.cameras: Dict[str, Dict[str, List[int]]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.cameras = json.load(f).get('cameras', {})
+            except (OSError, ValueError) as e:
+                logger.error(f'Sync index {path} is unreadable, starting empty: {e!r}')
+
+    @classmethod
+    def in_dir(cls, root: str) -> 'SyncIndex':
+        return cls(os.path.join(root, INDEX_FILE))
+
+    def is_fetched(self, serial: str, name: str, size: int, mod: int) -> bool:
+        known = self.cameras.get(serial, {}).get(name)
+        return known is not None and known[0] == size and known[1] == mod
+
+    def delta(self, serial: str, catalog: MediaCatalog, indices: List[int]) -> List[int]:
+        res = [i for i in indices
+               if not self.is_fetched(serial, catalog.names[i], catalog.size[i], catalog.mod[i])]
+        logger.info(f'{serial}: {len(indices) - len(res)} of {len(indices)} files already synced')
+        return res
+
+    def mark(self, serial: str, name: str, size: int, mod: int):
+        with self._lock:
+            self.cameras.setdefault(serial, {})[name] = [int(size), int(mod)]
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump({'cameras': self.cameras}, f)
+            os.replace(tmp, self.path)
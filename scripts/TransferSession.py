@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from typing import List, Optional
+
+import Commonds
+from ResponseTracker import ResponseTracker
+
+logger = logging.getLogger('rich')
+
+# protobuf命令的回复：feature id, action id, ResponseGeneric
+TURBO_RESPONSE_ACTION = 0xEB
+RESULT_SUCCESS = b'\x08\x01'
+
+
+# 批量下载前打开turbo transfer，结束时不管成功、出错还是被取消都要关掉
+class TransferSession:
+    def __init__(self, camera_list, wifi_list, enabled: bool = True):
+        self.camera_list = [camera for camera in camera_list if camera.get('bleak_client') is not None]
+        # wifi_list: the wifi_profile entries, offload_camera reads their 'turbo' flag
+        self.wifi_list = wifi_list
+        self.enabled = enabled
+        self.turbo: List[dict] = []
+
+    def _wifi_for(self, camera) -> Optional[dict]:
+        for wifi in self.wifi_list:
+            if wifi.get('address') == camera.get('address'):
+                return wifi
+        return None
+
+    async def _send(self, camera, command: bytearray, protobuf: bool = False) -> bool:
+        tracker: Optional[ResponseTracker] = camera.get('tracker')
+        if tracker is None:
+            await camera.get('bleak_client').write_gatt_char(Commonds.Characteristics.ControlCharacteristic,
+                                                             command, response=True)
+            return True
+        response = await tracker.send(command, check=False)
+        if protobuf:
+            return response.status == TURBO_RESPONSE_ACTION and response.payload.startswith(RESULT_SUCCESS)
+        return response.ok
+
+    async def _set_turbo(self, camera, on: bool) -> bool:
+        if not camera.get('bleak_client').is_connected:
+            return False
+        try:
+            if on:
+                # 相机只接受第三方客户端的turbo命令
+                await self._send(camera, Commonds.Commands.Analytics.SetThirdPartyClient)
+            ok = await self._send(camera, Commonds.Commands.Turbo.ON if on else Commonds.Commands.Turbo.OFF,
+                                  protobuf=True)
+        except Exception as e:
+            logger.error(f'Turbo {"on" if on else "off"} on {camera.get("target")} failed: {e!r}')
+            return False
+        if not ok:
+            logger.error(f'Camera {camera.get("target")} refused turbo {"on" if on else "off"}')
+        return ok
+
+    async def __aenter__(self):
+        if not self.enabled:
+            return self
+        ok = await asyncio.gather(*(self._set_turbo(camera, True) for camera in self.camera_list))
+        self.turbo = [camera for camera, good in zip(self.camera_list, ok) if good]
+        for camera in self.turbo:
+            wifi = self._wifi_for(camera)
+            if wifi is not None:
+                wifi['turbo'] = True
+        logger.info(f'Turbo transfer on for {[camera.get("target") for camera in self.turbo]}')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for camera in self.turbo:
+            wifi = self._wifi_for(camera)
+            if wifi is not None:
+                wifi['turbo'] = False
+        if self.turbo:
+            # shield: 被取消的时候也要把turbo关掉，否则相机一直停在传输界面
+            await asyncio.shield(asyncio.gather(*(self._set_turbo(camera, False) for camera in self.turbo)))
+            logger.info(f'Turbo transfer off for {[camera.get("target") for camera in self.turbo]}')
+        self.turbo = []
+        return False
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import logging
+import socket
+import struct
+import sys
+import time
+from typing import Dict, List, Optional
+
+import pywifi
+import requests
+from pywifi import const
+from requests.adapters import HTTPAdapter
+
+import Commonds
+
+logger = logging.getLogger('rich')
+
+# 扫描结果在这么长时间内都认为有效，不用重新扫
+DEFAULT_SCAN_TTL = 60.0
+DEFAULT_SCAN_TIMEOUT = 30.0
+DEFAULT_CONNECT_TIMEOUT = 20.0
+DEFAULT_HTTP_TIMEOUT = 15.0
+MIN_POLL = 0.1
+MAX_POLL = 1.0
+
+
+def poll_until(predicate, timeout: float, name: str) -> bool:
+    # 短间隔轮询，间隔逐渐变大，条件满足立刻返回
+    deadline = time.monotonic() + timeout
+    interval = MIN_POLL
+    while True:
+        if predicate():
+            return True
+        if time.monotonic() >= deadline:
+            logger.error(f'Timed out after {timeout}s waiting for {name}')
+            return False
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        interval = min(interval * 2, MAX_POLL)
+
+
+def interface_address(name: str) -> Optional[str]:
+    # IPv4 address of a network interface (Linux only)
+    try:
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            packed = fcntl.ioctl(sock.fileno(), 0x8915, struct.pack('256s', name[:15].encode()))  # SIOCGIFADDR
+        return socket.inet_ntoa(packed[20:24])
+    except (ImportError, OSError):
+        return None
+
+
+class BoundHTTPAdapter(HTTPAdapter):
+    # 所有相机的IP都是10.5.5.9，多网卡时必须把连接绑到对应网卡上
+    def __init__(self, iface_name: Optional[str] = None, source_address: Optional[str] = None, **kwargs):
+        self.iface_name = iface_name
+        self.source_address = source_address
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.source_address:
+            kwargs['source_address'] = (self.source_address, 0)
+        if self.iface_name and sys.platform.startswith('linux') and hasattr(socket, 'SO_BINDTODEVICE'):
+            from urllib3.connection import HTTPConnection
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.iface_name.encode())]
+        super().init_poolmanager(*args, **kwargs)
+
+
+class WifiManager:
+    def __init__(self, iface=None, scan_ttl: float = DEFAULT_SCAN_TTL, reset_profiles: bool = True):
+        self.iface = iface if iface is not None else pywifi.PyWiFi().interfaces()[0]
+        if reset_profiles:
+            # 只在开始时清一次旧的配置，之后每个SSID的配置都缓存复用
+            self.iface.remove_all_network_profiles()
+        self.scan_ttl = scan_ttl
+        # ssid -> profile added to the interface
+        self.profiles: Dict[str, pywifi.Profile] = {}
+        # ssid -> monotonic time it was last seen in a scan
+        self.seen: Dict[str, float] = {}
+        self.current: Optional[str] = None
+
+    def _update_seen(self) -> None:
+        now = time.monotonic()
+        for result in self.iface.scan_results():
+            self.seen[result.ssid] = now
+
+    def recently_seen(self, ssid: str) -> bool:
+        return time.monotonic() - self.seen.get(ssid, -self.scan_ttl - 1) <= self.scan_ttl
+
+    def find(self, ssid: str, timeout: float = DEFAULT_SCAN_TIMEOUT) -> bool:
+        if self.recently_seen(ssid):
+            return True
+        logger.info(f'scan for target wifi {ssid}')
+        self.iface.scan()
+
+        def visible():
+            self._update_seen()
+            return self.recently_seen(ssid)
+
+        return poll_until(visible, timeout, f'{ssid} to show up')
+
+    def profile_for(self, ssid: str, psw: str) -> pywifi.Profile:
+        profile = self.profiles.get(ssid)
+        if profile is not None and profile.key == psw:
+            return profile
+        if profile is not None:
+            self.iface.remove_network_profile(profile)
+        profile = pywifi.Profile()
+        profile.ssid = ssid
+        profile.auth = const.AUTH_ALG_OPEN
+        profile.akm.append(const.AKM_TYPE_WPAPSK)
+        profile.cipher = const.CIPHER_TYPE_CCMP
+        profile.key = psw
+        profile = self.iface.add_network_profile(profile)
+        self.profiles[ssid] = profile
+        return profile
+
+    @classmethod
+    def all(cls, limit: Optional[int] = None, **kwargs) -> List['WifiManager']:
+        # one manager per Wi-Fi adapter on the host
+        interfaces = pywifi.PyWiFi().interfaces()
+        return [cls(iface, **kwargs) for iface in interfaces[:limit or len(interfaces)]]
+
+    @property
+    def name(self) -> str:
+        return self.iface.name()
+
+    def adapter(self, **kwargs) -> BoundHTTPAdapter:
+        return BoundHTTPAdapter(self.name, interface_address(self.name), **kwargs)
+
+    def session(self, **kwargs) -> requests.Session:
+        session = requests.Session()
+        adapter = self.adapter(**kwargs)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def http_ready(self, base_url: str = Commonds.Characteristics.GoProBaseURL,
+                   timeout: float = DEFAULT_HTTP_TIMEOUT) -> bool:
+        url = base_url + Commonds.Commands.WiFi.KEEP_ALIVE
+        session = self.session()
+
+        def responds():
+            try:
+                return session.get(url, timeout=0.5).ok
+            except requests.RequestException:
+                return False
+
+        try:
+            return poll_until(responds, timeout, f'{url} to respond')
+        finally:
+            session.close()
+
+    def connect(self, ssid: str, psw: str, timeout: float = DEFAULT_CONNECT_TIMEOUT) -> bool:
+        if self.current == ssid and self.iface.status() == const.IFACE_CONNECTED:
+            logger.info(f'Already connected to {ssid}')
+            return True
+        if not self.find(ssid):
+            logger.info(f'Connected to {ssid} failed!')
+            return False
+        self.current = None
+        self.iface.disconnect()
+        poll_until(lambda: self.iface.status() in (const.IFACE_DISCONNECTED, const.IFACE_INACTIVE), 5.0,
+                   'interface to disconnect')
+        logger.info(f'connect for target wifi {ssid}')
+        self.iface.connect(self.profile_for(ssid, psw))
+        if not poll_until(lambda: self.iface.status() == const.IFACE_CONNECTED, timeout, f'{ssid} to associate') \
+                or not self.http_ready():
+            logger.info(f'Connected to {ssid} failed!')
+            return False
+        self.current = ssid
+        logger.info(f'Connected to {ssid} successfully!')
+        return True
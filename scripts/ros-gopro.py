@@ -6,49 +6,240 @@
 '''
 # Importing libraries
 import rospy
-from std_msgs.msg import Empty, String, UInt8
-import requests
+from std_msgs.msg import Empty, String, UInt8, UInt32
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+import collections
+import socket
 import threading
 import time
+import HttpClient
 
-# Request process
-def request_proc(URL):
+# Trigger policies
+# fifo: send every trigger in order (oldest dropped and reported when the queue is full)
+# coalesce: a new trigger replaces a pending one of the same kind
+# drop_stale: like fifo, but triggers older than max_age are dropped
+POLICIES = ('fifo', 'coalesce', 'drop_stale')
+
+# Request process (pooled keep-alive connection, bounded timeouts and retries)
+def request_proc(URL, client=None):
     PARAMS = {}
-    r = requests.get(url = URL, params = PARAMS)
+    r = (client or HttpClient.default_client()).get(URL, params = PARAMS)
+    return r
+
+# Background trigger worker, keeps the subscriber callbacks non-blocking
+class GOPRO_TRIGGER_WORKER(object):
+
+    def __init__(self, policy='coalesce', max_age=1.0, queue_size=10):
+        if policy not in POLICIES:
+            rospy.logwarn("Unknown trigger policy " + policy + ", using coalesce")
+            policy = 'coalesce'
+        self.policy = policy
+        self.max_age = max_age
+        # Own pooled connections, separated from the live-stream monitor.
+        # No retries: a retried trigger would fire late, past max_age
+        self.client = HttpClient.HttpClient(retries=0)
+        self.pending = collections.deque(maxlen=queue_size)
+        # Triggers lost to the queue limit or to max_age
+        self.dropped = 0
+        self.cond = threading.Condition()
+        self.p_diag = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=10)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    # Called from the rospy callbacks, only enqueues
+    def submit(self, name, URL):
+        stamp = time.monotonic()
+        with self.cond:
+            if self.policy == 'coalesce':
+                for trigger in list(self.pending):
+                    if trigger[0] == name:
+                        self.pending.remove(trigger)
+                        self.publish(name, 'coalesced', stamp - trigger[2], 0.0)
+            if len(self.pending) == self.pending.maxlen:
+                # The deque would silently drop the oldest trigger
+                evicted = self.pending[0]
+                self.dropped += 1
+                rospy.logwarn(evicted[0] + " trigger dropped, queue full")
+                self.publish(evicted[0], 'evicted', stamp - evicted[2], 0.0)
+            self.pending.append((name, URL, stamp))
+            self.cond.notify()
+
+    def run(self):
+        while not rospy.is_shutdown():
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                name, URL, stamp = self.pending.popleft()
+            queued = time.monotonic() - stamp
+            if self.policy == 'drop_stale' and queued > self.max_age:
+                rospy.logwarn(name + " trigger dropped, " + str(round(queued, 3)) + "s old")
+                self.dropped += 1
+                self.publish(name, 'dropped', queued, 0.0)
+                continue
+            sent = time.monotonic()
+            try:
+                r = request_proc(URL, self.client)
+                status = 'ok' if r.status_code == 200 else 'http ' + str(r.status_code)
+            except Exception as e:
+                status = repr(e)
+            self.publish(name, status, queued, time.monotonic() - sent)
+
+    # Publishes how late the trigger fired (queue delay) and the camera round trip
+    def publish(self, name, status, queued, round_trip):
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        diag = DiagnosticStatus()
+        diag.name = rospy.get_name() + ": " + name
+        diag.hardware_id = "gopro"
+        diag.level = DiagnosticStatus.OK if status == 'ok' else DiagnosticStatus.WARN
+        diag.message = status
+        diag.values = [KeyValue("queue_delay", str(queued)),
+                       KeyValue("round_trip", str(round_trip)),
+                       KeyValue("latency", str(queued + round_trip)),
+                       KeyValue("dropped", str(self.dropped))]
+        msg.status.append(diag)
+        self.p_diag.publish(msg)
 
 # Shutter callback (shoot photo, start recording)
-def cb_shutter(msg, URL):
+def cb_shutter(msg, args):
+    worker, URL = args
     rospy.loginfo("Shutter activated\n" )
-    request_proc(URL)
+    worker.submit('shutter', URL)
 
 # Stop signal callback (stop recording)
-def cb_stop(msg, URL):
+def cb_stop(msg, args):
+    worker, URL = args
     rospy.loginfo("Recording stopped\n")
-    request_proc(URL)
+    worker.submit('stop', URL)
+
+# UDP keep-alive understood by the GOPRO live stream
+KEEPALIVE_MSG = b"_GPHD_:0:0:2:0.000000\n"
 
-# Live-streaming monitor
+# Frame-count probe for the live stream.
+# The driver owns the UDP port, so nothing here binds it; instead the driver publishes its decoded
+# frame count on gopro_frames about once a second, and the stream is alive while that count grows.
+class GOPRO_STREAM_PROBE(object):
+
+    def __init__(self):
+        self.frames = None
+        self.last_frame = None
+        self.s_frames = rospy.Subscriber("gopro_frames", UInt32, self.cb_frames, queue_size=1)
+
+    def cb_frames(self, msg):
+        if self.frames is None or msg.data > self.frames:
+            self.last_frame = time.monotonic()
+        self.frames = msg.data
+
+    def gap(self):
+        if self.last_frame is None:
+            return float("inf")
+        return time.monotonic() - self.last_frame
+
+# Live-streaming monitor, adaptive keep-alive
 class GOPRO_LIVE_MON(object):
 
-    def __init__(self, url):
+    def __init__(self, url, stream_url="udp://10.5.5.9:8554", period=2.5, max_gap=3.0, max_backoff=30.0):
+        self.url = url
+        self.period = period
+        self.max_gap = max_gap
+        self.max_backoff = max_backoff
+        hostport = stream_url.split("://")[-1]
+        self.host = hostport.split(":")[0]
+        self.port = int(hostport.split(":")[1]) if ":" in hostport else 8554
+        self.probe = GOPRO_STREAM_PROBE()
+        # Bounded timeouts, no retries: a hung request must never stall the keep-alive
+        self.client = HttpClient.HttpClient(timeout=(1.0, 2.0), retries=0)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Statistics
+        self.streaming = False
+        self.up_since = None
+        self.gap_since = None
+        self.gaps = 0
+        self.last_gap = 0.0
+        self.longest_gap = 0.0
+        self.restarts = 0
         thread = threading.Thread(target=self.run, args=(url,))
         thread.daemon = True
         thread.start()
 
-    def run(self, URL):
-        # Create publisher
-        p_live = rospy.Publisher("gp_live", Empty, queue_size=10)
+    def restart(self, URL):
+        rospy.loginfo("Signal sent to " + URL)
+        PARAMS = {}
+        try:
+            r = self.client.get(URL, params = PARAMS)
+        except Exception as e:
+            rospy.logwarn("Live restart failed: " + repr(e))
+            return False
+        rospy.loginfo("Result: " + str(r.status_code))
+        self.restarts += 1
+        return r.status_code == 200
 
-        while True:
-            # Sending the request and saving response
-            rospy.loginfo("Signal sent to " + URL)
-            PARAMS = {}
-            r = requests.get(url = URL, params = PARAMS)
-            rospy.loginfo("Result: " + str(r.status_code))
-            if(r.status_code == 200):
-                msg = Empty()
-                p_live.publish(msg)
-            time.sleep(10)
+    def update(self, now, gap):
+        healthy = gap <= self.max_gap
+        if healthy and not self.streaming:
+            if self.gap_since is not None:
+                self.last_gap = now - self.gap_since
+                self.longest_gap = max(self.longest_gap, self.last_gap)
+            self.up_since = now
+            self.gap_since = None
+        elif not healthy and self.streaming:
+            self.gaps += 1
+            self.up_since = None
+            # The stream stopped when the last packet arrived
+            self.gap_since = now - gap
+        elif not healthy and self.gap_since is None:
+            self.gap_since = now
+        self.streaming = healthy
+        return healthy
 
+    def publish(self, now):
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        diag = DiagnosticStatus()
+        diag.name = rospy.get_name() + ": live stream"
+        diag.hardware_id = "gopro"
+        diag.level = DiagnosticStatus.OK if self.streaming else DiagnosticStatus.ERROR
+        diag.message = "streaming" if self.streaming else "no packets"
+        uptime = now - self.up_since if self.up_since is not None else 0.0
+        diag.values = [KeyValue("uptime", str(uptime)),
+                       KeyValue("gaps", str(self.gaps)),
+                       KeyValue("last_gap", str(self.last_gap)),
+                       KeyValue("longest_gap", str(self.longest_gap)),
+                       KeyValue("restarts", str(self.restarts))]
+        msg.status.append(diag)
+        self.p_diag.publish(msg)
+
+    def run(self, URL):
+        # Create publisher, latched so a driver that subscribes late still gets the wake-up
+        p_live = rospy.Publisher("gp_live", Empty, queue_size=10, latch=True)
+        self.p_diag = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=10)
+
+        backoff = self.period
+        next_restart = time.monotonic()
+        start = time.monotonic()
+        tick = 0
+        while not rospy.is_shutdown():
+            now = time.monotonic()
+            healthy = self.update(now, self.probe.gap())
+            if healthy:
+                # Cheap keep-alive datagram, no HTTP while the stream is fine
+                try:
+                    self.udp.sendto(KEEPALIVE_MSG, (self.host, self.port))
+                except OSError as e:
+                    rospy.logwarn("Keep-alive failed: " + repr(e))
+                backoff = self.period
+            elif now >= next_restart:
+                # Restart only when packets stopped, backing off while it keeps failing
+                if self.restart(URL):
+                    msg = Empty()
+                    p_live.publish(msg)
+                next_restart = now + backoff
+                backoff = min(backoff * 2, self.max_backoff)
+            self.publish(now)
+            # Drift-free schedule
+            tick += 1
+            time.sleep(max(start + tick * self.period - time.monotonic(), 0))
 
 # Init function
 def init():
@@ -58,13 +249,18 @@ def init():
     shutter_url = rospy.get_param("trigger")
     stop_url = rospy.get_param("stop")
     live_url = rospy.get_param("wake_up_live")
+    stream_url = rospy.get_param("live_url", "udp://10.5.5.9:8554")
+
+    policy = rospy.get_param("~trigger_policy", "coalesce")
+    max_age = rospy.get_param("~trigger_max_age", 1.0)
 
     # Setting up subscribers
-    s_shutter = rospy.Subscriber('gp_shutter', Empty, cb_shutter, shutter_url)
-    s_stop = rospy.Subscriber('gp_stop', Empty, cb_stop, stop_url)
+    worker = GOPRO_TRIGGER_WORKER(policy, max_age)
+    s_shutter = rospy.Subscriber('gp_shutter', Empty, cb_shutter, (worker, shutter_url))
+    s_stop = rospy.Subscriber('gp_stop', Empty, cb_stop, (worker, stop_url))
 
     # Create thread for live stream
-    gopro_mon =  GOPRO_LIVE_MON(live_url)
+    gopro_mon =  GOPRO_LIVE_MON(live_url, stream_url)
 
     # "Refresh" ros node
     rospy.spin()
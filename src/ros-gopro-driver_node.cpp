@@ -7,6 +7,7 @@
 #include <opencv2/highgui/highgui.hpp>
 #include <opencv2/video/video.hpp>
 #include <std_msgs/Empty.h>
+#include <std_msgs/UInt32.h>
 
 // Include c++ libraries
 #include <stdio.h>
@@ -72,6 +73,10 @@ int main(int argc, char* argv[])
     //Advertise img topic
     img_pub = it.advertise("gopro_out",100);
 
+    //Decoded frame count, about once a second; a cheap health signal for the live monitor
+    ros::Publisher frames_pub = n.advertise<std_msgs::UInt32>("gopro_frames", 1);
+    ros::Time last_beat;
+
     //Get GOPRO livestream url
     std::string gopro_url;
     n.param<std::string>("live_url", gopro_url, "udp://10.5.5.9:8554");
@@ -229,6 +234,15 @@ int main(int argc, char* argv[])
 
                 //Update counter
                 cnt++;
+
+                //Heartbeat
+                if(header.stamp - last_beat >= ros::Duration(1.0))
+                {
+                    std_msgs::UInt32 frames;
+                    frames.data = cnt;
+                    frames_pub.publish(frames);
+                    last_beat = header.stamp;
+                }
             }
 
             //Free the packet